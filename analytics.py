@@ -0,0 +1,307 @@
+import argparse
+import csv
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np  # лише для аналітики; парсеру не потрібен
+except ImportError:
+    np = None
+
+# Константи
+TRACKED_CSV = 'output.csv'  # файл, який workflow комітить кожні 2 години
+ANALYTICS_FILE = 'sales_matrix.npz'
+ANALYTICS_WINDOW_HOURS = 7 * 24  # вікно для швидкості продажів
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise ImportError("Для аналітики потрібен numpy: pip install numpy")
+
+
+def _git(repo: str, *args: str) -> str:
+    return subprocess.run(['git', '-C', repo, *args], check=True, capture_output=True, text=True).stdout
+
+
+def iter_commits(repo: str = '.', path: str = TRACKED_CSV,
+                 since: Optional[str] = None) -> List[Tuple[str, int]]:
+    """Коміти, що змінювали path (від старих до нових): [(хеш, час коміту)]. since - лише новіші за нього."""
+    revision = f"{since}..HEAD" if since else 'HEAD'
+    rows = _git(repo, 'log', '--reverse', '--format=%H %ct', revision, '--', path).split()
+    return [(rows[i], int(rows[i + 1])) for i in range(0, len(rows), 2)]
+
+
+def iter_blobs(repo: str, path: str, commits: List[Tuple[str, int]]) -> Iterator[Tuple[str, int, bytes]]:
+    """
+    Вміст path у кожному коміті одним процесом `git cat-file --batch`,
+    без checkout. Коміти, де файлу немає (видалено), пропускаються.
+    """
+    process = subprocess.Popen(['git', '-C', repo, 'cat-file', '--batch'],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        for commit, ts in commits:
+            process.stdin.write(f"{commit}:{path}\n".encode())
+            process.stdin.flush()
+            header = process.stdout.readline().split()
+            if len(header) != 3:  # "<об'єкт> missing"
+                continue
+            size = int(header[2])
+            content = process.stdout.read(size)
+            process.stdout.read(1)  # перенесення рядка після об'єкта
+            yield commit, ts, content
+    finally:
+        process.stdin.close()
+        process.stdout.close()
+        process.wait()
+
+
+def _parse_snapshot(content: bytes) -> Dict[str, Tuple[str, float, float, str]]:
+    """SKU (або page_name) → (назва, current_qty, max_qty, ціна) з одного знімка CSV."""
+    rows = {}
+    for row in csv.DictReader(io.StringIO(content.decode('utf-8-sig', 'replace'))):
+        key = row.get('SKU') or row.get('page_name')
+        if not key:
+            continue
+        try:
+            rows[key] = (row.get('car_name', ''), float(row['current_qty']), float(row['max_qty']),
+                         row.get('price', ''))
+        except (KeyError, TypeError, ValueError):
+            continue  # знімок з пошкодженим рядком
+    return rows
+
+
+class SalesMatrix:
+    """
+    Залишки всіх продуктів у часі з історії git: рядок - продукт (SKU),
+    стовпець - коміт output.csv. Відсутній у знімку продукт - NaN.
+
+    Матриця зберігається в ANALYTICS_FILE разом з останнім прочитаним
+    комітом, тож update() читає лише новіші коміти.
+    """
+
+    def __init__(self, keys: List[str], names: List[str], prices: List[str],
+                 timestamps, qty, max_qty, last_commit: Optional[str] = None):
+        self.keys = keys
+        self.names = names
+        self.prices = prices
+        self.timestamps = timestamps  # int64[T], секунди
+        self.qty = qty  # float32[N, T]
+        self.max_qty = max_qty  # float32[N, T]
+        self.last_commit = last_commit
+        self._rows = {key: i for i, key in enumerate(keys)}
+
+    @classmethod
+    def empty(cls) -> 'SalesMatrix':
+        _require_numpy()
+        return cls([], [], [], np.zeros(0, dtype=np.int64),
+                   np.zeros((0, 0), dtype=np.float32), np.zeros((0, 0), dtype=np.float32))
+
+    @classmethod
+    def load(cls, path: str = ANALYTICS_FILE) -> 'SalesMatrix':
+        _require_numpy()
+        if not os.path.exists(path):
+            return cls.empty()
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['keys'].tolist(), data['names'].tolist(), data['prices'].tolist(),
+                       data['timestamps'], data['qty'], data['max_qty'], str(data['last_commit']) or None)
+
+    def save(self, path: str = ANALYTICS_FILE) -> None:
+        """Атомарно: тимчасовий файл поруч і os.replace."""
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.tmp',
+                                        dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, keys=np.array(self.keys, dtype=str), names=np.array(self.names, dtype=str),
+                                    prices=np.array(self.prices, dtype=str), timestamps=self.timestamps,
+                                    qty=self.qty, max_qty=self.max_qty,
+                                    last_commit=np.array(self.last_commit or ''))
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def update(self, repo: str = '.', path: str = TRACKED_CSV) -> int:
+        """Дочитує коміти після last_commit. Повертає кількість нових знімків."""
+        since = self.last_commit
+        if since:
+            try:
+                _git(repo, 'merge-base', '--is-ancestor', since, 'HEAD')
+            except subprocess.CalledProcessError:
+                print(f"⚠️ Коміт {since[:10]} більше не в історії, перечитуємо все")
+                self.__dict__.update(vars(SalesMatrix.empty()))
+                since = None
+        commits = iter_commits(repo, path, since)
+        if not commits:
+            return 0
+
+        timestamps, columns = [], []
+        for commit, ts, content in iter_blobs(repo, path, commits):
+            snapshot = _parse_snapshot(content)
+            for key, (name, _, _, price) in snapshot.items():
+                row = self._rows.get(key)
+                if row is None:
+                    self._rows[key] = len(self.keys)
+                    self.keys.append(key)
+                    self.names.append(name)
+                    self.prices.append(price)
+                else:
+                    self.names[row], self.prices[row] = name, price
+            timestamps.append(ts)
+            columns.append(snapshot)
+        self.last_commit = commits[-1][0]
+
+        # Нові стовпці заповнюються одним присвоєнням за індексами на знімок
+        added = len(columns)
+        qty = np.full((len(self.keys), added), np.nan, dtype=np.float32)
+        max_qty = np.full((len(self.keys), added), np.nan, dtype=np.float32)
+        for column, snapshot in enumerate(columns):
+            rows = np.fromiter((self._rows[key] for key in snapshot), dtype=np.int64, count=len(snapshot))
+            values = np.array([(value[1], value[2]) for value in snapshot.values()],
+                              dtype=np.float32).reshape(-1, 2)
+            qty[rows, column] = values[:, 0]
+            max_qty[rows, column] = values[:, 1]
+
+        grow = len(self.keys) - self.qty.shape[0]
+        padding = np.full((grow, self.qty.shape[1]), np.nan, dtype=np.float32)
+        self.qty = np.hstack([np.vstack([self.qty, padding]), qty])
+        self.max_qty = np.hstack([np.vstack([self.max_qty, padding]), max_qty])
+        self.timestamps = np.concatenate([self.timestamps, np.array(timestamps, dtype=np.int64)])
+        return added
+
+
+def _last_valid(matrix):
+    """Останнє не-NaN значення кожного рядка (NaN, якщо рядок порожній)."""
+    valid = ~np.isnan(matrix)
+    index = matrix.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    values = matrix[np.arange(matrix.shape[0]), index]
+    return np.where(valid.any(axis=1), values, np.nan)
+
+
+def compute_metrics(matrix: SalesMatrix, window_hours: float = ANALYTICS_WINDOW_HOURS) -> Dict[str, object]:
+    """
+    Метрики для всього каталогу одразу (масиви довжини N):
+      sold_window     - продано за вікно (сума зменшень current_qty)
+      per_day         - швидкість продажів, шт./добу (за вікно або час, відколи продукт з'явився)
+      current_qty     - останній залишок (NaN - продукту немає в останньому знімку)
+      days_to_sellout - оцінка часу до розпродажу при поточній швидкості (inf - не продається)
+      restocks        - кількість поповнень (зростань current_qty)
+      run_size        - оцінка тиражу: перший побачений залишок + усі поповнення
+      run_vs_max      - run_size / max_qty
+      sell_through    - частка тиражу, що вже продана
+    і restock_events - (рядки, стовпці, кількість) кожного поповнення.
+    """
+    _require_numpy()
+    qty = matrix.qty
+    products, snapshots = qty.shape
+    if products == 0 or snapshots == 0:
+        return {'products': 0}
+
+    # Зміни між сусідніми знімками; NaN (продукту не було) - не продаж і не поповнення
+    deltas = np.diff(qty, axis=1)
+    sold = np.nan_to_num(np.clip(-deltas, 0, None))
+    restocked = np.nan_to_num(np.clip(deltas, 0, None))
+
+    # Вікно: інтервали, що закінчуються після now - window
+    now = matrix.timestamps[-1]
+    start = int(np.searchsorted(matrix.timestamps, now - window_hours * 3600))
+    first_interval = max(start - 1, 0)
+    sold_window = sold[:, first_interval:].sum(axis=1)
+    window = qty[:, first_interval:]
+    present = ~np.isnan(window)
+    first_seen = matrix.timestamps[first_interval + np.argmax(present, axis=1)]
+    hours = np.where(present.any(axis=1), (now - first_seen) / 3600, 0.0)
+    per_hour = np.divide(sold_window, hours, out=np.zeros(products), where=hours > 0)
+
+    current = qty[:, -1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hours_left = np.where(current <= 0, 0.0, np.where(per_hour > 0, current / per_hour, np.inf))
+
+    first_valid = np.argmax(~np.isnan(qty), axis=1)
+    first_qty = np.nan_to_num(qty[np.arange(products), first_valid])
+    run_size = first_qty + restocked.sum(axis=1)
+    max_qty = _last_valid(matrix.max_qty)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        run_vs_max = np.where(max_qty > 0, run_size / max_qty, np.nan)
+        sell_through = np.where(run_size > 0, sold.sum(axis=1) / run_size, np.nan)
+
+    event_rows, event_columns = np.nonzero(restocked)
+    return {
+        'products': products,
+        'sold_window': sold_window,
+        'per_day': per_hour * 24,
+        'current_qty': current,
+        'days_to_sellout': hours_left / 24,
+        'restocks': (restocked > 0).sum(axis=1),
+        'run_size': run_size,
+        'max_qty': max_qty,
+        'run_vs_max': run_vs_max,
+        'sell_through': sell_through,
+        # Поповнення між стовпцями c і c + 1 відбулося до знімка c + 1
+        'restock_events': (event_rows, event_columns + 1, restocked[event_rows, event_columns]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Аналітика продажів з історії output.csv у git")
+    parser.add_argument('--repo', default='.')
+    parser.add_argument('--file', default=ANALYTICS_FILE)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('backfill', help="прочитати нові коміти output.csv у матрицю")
+
+    report = commands.add_parser('report', help="швидкість продажів і оцінка розпродажу")
+    report.add_argument('--hours', type=float, default=ANALYTICS_WINDOW_HOURS, help="вікно швидкості продажів")
+    report.add_argument('--limit', type=int, default=30)
+
+    restocks = commands.add_parser('restocks', help="поповнення за останні N годин")
+    restocks.add_argument('--hours', type=float, default=ANALYTICS_WINDOW_HOURS)
+
+    args = parser.parse_args()
+    if np is None:
+        print("❌ Для аналітики потрібен numpy: pip install numpy")
+        sys.exit(1)
+
+    matrix = SalesMatrix.load(args.file)
+    if args.command == 'backfill':
+        started = time.perf_counter()
+        added = matrix.update(args.repo)
+        if added:
+            matrix.save(args.file)
+        print(f"📚 Додано {added} знімків за {time.perf_counter() - started:.1f}с; "
+              f"усього {len(matrix.keys)} продуктів × {len(matrix.timestamps)} знімків")
+        return
+
+    if not len(matrix.timestamps):
+        print(f"❌ {args.file} порожній, спершу запустіть backfill")
+        sys.exit(1)
+    metrics = compute_metrics(matrix, args.hours if args.command == 'report' else ANALYTICS_WINDOW_HOURS)
+    if args.command == 'report':
+        # Лише продукти з останнього знімка, що продаються
+        listed = ~np.isnan(metrics['current_qty']) & (metrics['per_day'] > 0)
+        order = np.flatnonzero(listed)[np.argsort(-metrics['per_day'][listed], kind='stable')][:args.limit]
+        for i in order:
+            days = metrics['days_to_sellout'][i]
+            eta = 'не продається' if np.isinf(days) else f"{days:7.1f} дн."
+            print(f"{matrix.keys[i]:<10} {matrix.names[i][:40]:<40} "
+                  f"залишок {metrics['current_qty'][i]:>7.0f}  {metrics['per_day'][i]:>7.1f}/добу  "
+                  f"розпродаж {eta}  тираж ~{metrics['run_size'][i]:.0f} "
+                  f"({metrics['run_vs_max'][i]:.0%} max_qty), поповнень {metrics['restocks'][i]}")
+    else:
+        rows, columns, amounts = metrics['restock_events']
+        since = matrix.timestamps[-1] - args.hours * 3600
+        for row, column, amount in zip(rows, columns, amounts):
+            if matrix.timestamps[column] >= since:
+                moment = time.strftime('%Y-%m-%d %H:%M', time.gmtime(matrix.timestamps[column]))
+                print(f"{moment}  {matrix.keys[row]:<10} +{amount:.0f}  {matrix.names[row][:60]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,55 @@
 import requests
+import codecs
+import io
+import argparse
 import csv
+import hashlib
 import os
 import json
+import multiprocessing
+import queue
+import re
+import sys
+import signal
 import time
-from typing import List, Dict, Tuple, Optional
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator, Callable
 from playwright.sync_api import sync_playwright, Browser
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, field
+from contextlib import contextmanager, nullcontext, redirect_stdout
 from functools import wraps
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+from feed import ChangeFeed, default_sinks, stock_events
+from history import HistoryStore
+from registry import REGISTRY_FILE, Registry, Storefront, load_registry
+from traffic import REPLAY_TIMINGS, TRAFFIC_FILE, TrafficRecorder, TrafficReplayer
+from metrics import get_metrics, reset_metrics
+from query import QUERY_HOST, QUERY_PORT, ProductIndex, QueryServer
+import resilience
+from resilience import CircuitOpenError, HostGuard, backoff_delay, is_transient, retry_after_seconds
+
+try:
+    import fcntl  # блокування файлу кешу токена між процесами (немає на Windows)
+except ImportError:
+    fcntl = None
+
+try:
+    import httpx  # необов'язково: потрібен лише для HTTP/2 (pip install httpx[http2])
+except ImportError:
+    httpx = None
 
 # Константи
 API_BASE_URL = "https://mattel-creations-searchspring-proxy.netlify.app/api/search"
 INVENTORY_API_URL = "https://mattel-checkout-prd.fly.dev/api/product-inventory"
 CHECKOUT_URL = "https://creations.mattel.com/checkouts/cn/hWN4eQSmROJAn1IYF6ZTjU27/en-us?auto_redirect=false&edge_redirect=true&skip_shop_pay=true"
 
-CSV_FIELDNAMES = ['car_name', 'SKU', 'page_name', 'max_qty', 'current_qty', 'image_url', 'price']
+# uid останнім стовпцем: details.html читає стовпці за позицією
+CSV_FIELDNAMES = ['car_name', 'SKU', 'page_name', 'max_qty', 'current_qty', 'image_url', 'price', 'uid']
 TARGET_CATEGORIES = [['Vehicles'], ['Action Figures']]
 
 COLLECTIONS = [
@@ -23,15 +59,83 @@ COLLECTIONS = [
     'mattel-creations|mattel-creations'
 ]
 
+# Колекції, категорії та вітрини перевизначаються в collections.json (див. registry.py)
+REGISTRY = load_registry(REGISTRY_FILE, default=Registry.single(COLLECTIONS, TARGET_CATEGORIES))
+COLLECTIONS = REGISTRY.names()
+TARGET_CATEGORIES = REGISTRY.categories
+
 # Налаштування retry
 MAX_RETRIES = 3
-RETRY_DELAY = 2  # секунд
+RETRY_DELAY = 2  # секунд, база експоненційної затримки між повторами
 TOKEN_WAIT_TIMEOUT = 20  # секунд
-
-
-@dataclass
+TOKEN_CACHE_FILE = '.token_cache.json'  # None - не зберігати токен на диску
+TOKEN_KEEP_BROWSER = False  # тримати браузер відкритим між оновленнями токена
+TOKEN_BACKGROUND_REFRESH = True  # оновлювати токен у фоні до закінчення терміну дії
+TOKEN_REFRESH_MARGIN = 60  # секунд до кінця терміну, коли фоновий потік отримує новий токен
+TOKEN_LIFETIME_SAFETY = 30  # секунд запасу від спостереженого часу життя токена
+TOKEN_MIN_LIFETIME = 90  # нижня межа оцінки часу життя
+
+# Налаштування паралельності
+MAX_WORKERS = 8  # максимум одночасних запитів до INVENTORY_API_URL
+
+# Налаштування пакетних запитів інвентарю
+INVENTORY_BATCH_SIZE = 25  # стартовий розмір пакета productIds
+INVENTORY_BATCH_MAX = 100  # верхня межа (обмежена довжиною URL)
+BATCH_REJECT_STATUSES = {400, 413, 414}  # відповіді, якими сервер відхиляє завеликий пакет
+CATALOG_WORKERS = 4  # одночасних запитів до API_BASE_URL
+PROCESSES = 1  # процесів для запитів інвентарю (див. --processes)
+SHARD_CHUNK_SIZE = 200  # продуктів в одному завданні для процесу
+
+# Налаштування потокової обробки
+STREAM_CHUNK_SIZE = 64 * 1024  # байтів відповіді пошуку за одне читання
+CATALOG_CACHE_FILE = 'catalog_cache.json'  # хеші сторінок і елементів пошуку, зняті з продажу продукти
+STREAM_QUEUE_SIZE = 500  # продуктів у черзі між пошуком та запитами інвентарю
+PIPELINE_FLUSH_EVERY = 200  # зберігати результати кожні N оновлених продуктів
+
+DELTA_FILE = 'output_delta.csv'  # зміни останнього запуску
+RUN_REPORT_FILE = 'run_report.json'  # JSON-звіт запуску (етапи, запити, лічильники)
+PROMETHEUS_FILE = 'metrics.prom'  # той самий звіт для textfile collector node_exporter
+QUIET = False  # не виводити рядки для кожного продукту (див. --quiet)
+DELTA_FIELDNAMES = ['change'] + CSV_FIELDNAMES
+
+# Налаштування планувальника оновлень
+SCHEDULE_FILE = 'refresh_state.json'
+REFRESH_MIN_INTERVAL = 2 * 3600  # не частіше, ніж запускається cron
+REFRESH_MAX_INTERVAL = 48 * 3600  # навіть "сплячі" продукти перевіряємо раз на 2 доби
+REFRESH_TARGET_DELTA = 5  # на скільки одиниць має змінитися залишок між перевірками
+REFRESH_RATE_SMOOTHING = 0.3  # вага нового спостереження в оцінці швидкості
+REFRESH_SLACK = 15 * 60  # допуск, щоб зсув часу запуску cron не пропускав продукт
+
+# Налаштування режиму спостереження (--watch)
+WATCH_INTERVAL = 15 * 60  # секунд між оновленнями колекції за замовчуванням
+WATCH_INTERVALS: Dict[str, int] = {}  # окремі інтервали, напр. {'mattel-creations|mattel-creations': 3600}
+WATCH_FLUSH_INTERVAL = 60  # секунд між записами файлів під час оновлення
+WATCH_COMPACT_INTERVAL = 24 * 3600  # як часто проріджувати історію
+
+# Налаштування відновлення перерваних запусків
+RUN_MANIFEST_FILE = 'run_manifest.json'  # які uid уже оновлені в поточному циклі
+RUN_RESUME_MAX_AGE = 3 * REFRESH_MIN_INTERVAL  # кілька пропущених запусків cron; старіший незавершений цикл починається заново
+REFRESH_BUDGET: Optional[int] = None  # максимум продуктів за запуск (None - без обмежень)
+
+# Налаштування HTTP
+HTTP_POOL_SIZE = 16  # з'єднань на хост (не менше за MAX_WORKERS)
+HTTP_USE_HTTP2 = False  # HTTP/2 через httpx, якщо він встановлений
+INVENTORY_HEADERS = {
+    "Accept": "application/json",
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
+    "Origin": "https://extensions.shopifycdn.com",
+    "Referer": "https://extensions.shopifycdn.com/",
+}
+
+
+@dataclass(slots=True)
 class Product:
-    """Клас для представлення продукту."""
+    """
+    Клас для представлення продукту.
+
+    slots=True: без __dict__ на кожен екземпляр, що помітно на сотнях тисяч
+    продуктів кількох вітрин.
+    """
     car_name: str
     SKU: str
     page_name: str
@@ -40,28 +144,41 @@ class Product:
     uid: str
     max_qty: int = 0
     current_qty: int = 0
+    collections: List[str] = field(default_factory=list)  # колекції, де зустрічається продукт
+    checked_at: Optional[float] = None  # час останнього успішного запиту інвентарю
+
+    def csv_row(self) -> Tuple[str, ...]:
+        """Рядок CSV у порядку CSV_FIELDNAMES (без проміжного словника)."""
+        return (self.car_name, self.SKU, self.page_name, str(self.max_qty), str(self.current_qty),
+                self.image_url, self.price, self.uid)
 
     def to_csv_dict(self) -> Dict:
         """Конвертує продукт у словник для CSV."""
-        return {
-            'car_name': self.car_name,
-            'SKU': self.SKU,
-            'page_name': self.page_name,
-            'max_qty': str(self.max_qty),
-            'current_qty': str(self.current_qty),
-            'image_url': self.image_url,
-            'price': self.price
-        }
+        return dict(zip(CSV_FIELDNAMES, self.csv_row()))
+
+    @property
+    def key(self) -> Tuple[str, str, str]:
+        """Первинний ключ продукту в CSV."""
+        return self.page_name, self.car_name, self.SKU
 
     def matches(self, other: 'Product') -> bool:
         """Перевіряє чи продукти співпадають."""
-        return (self.page_name == other.page_name and
-                self.car_name == other.car_name and
-                self.SKU == other.SKU)
+        return self.key == other.key
+
 
+def log_item(message: str) -> None:
+    """Вивід для окремого продукту чи пакета; вимикається в тихому режимі."""
+    if not QUIET:
+        print(message)
 
-def retry_on_failure(max_attempts: int = MAX_RETRIES, delay: int = RETRY_DELAY):
-    """Декоратор для повторення запитів при помилках."""
+
+def retry_on_failure(max_attempts: int = MAX_RETRIES, delay: float = RETRY_DELAY,
+                     retry_if: Callable[[Exception], bool] = lambda e: not isinstance(e, CircuitOpenError)):
+    """
+    Декоратор для повторення запитів при помилках.
+    Затримка росте експоненційно з джитером; Retry-After сервера має пріоритет.
+    retry_if вирішує, які помилки варто повторювати.
+    """
 
     def decorator(func):
         @wraps(func)
@@ -70,11 +187,16 @@ def retry_on_failure(max_attempts: int = MAX_RETRIES, delay: int = RETRY_DELAY):
                 try:
                     return func(*args, **kwargs)
                 except requests.RequestException as e:
+                    if not retry_if(e):
+                        raise
                     if attempt == max_attempts:
                         print(f"❌ Всі {max_attempts} спроби невдалі: {e}")
                         raise
-                    print(f"⚠️ Спроба {attempt}/{max_attempts} невдала, повтор через {delay}с...")
-                    time.sleep(delay)
+                    wait = max(backoff_delay(attempt, delay),
+                               retry_after_seconds(getattr(e, 'response', None)) or 0)
+                    get_metrics().inc('retries', function=func.__name__)
+                    log_item(f"⚠️ Спроба {attempt}/{max_attempts} невдала, повтор через {wait:.1f}с...")
+                    time.sleep(wait)
             return None
 
         return wrapper
@@ -89,80 +211,757 @@ def remove_url_params(url: str) -> str:
     return url.split('?')[0]
 
 
-@retry_on_failure(max_attempts=2)
-def fetch_data_from_api(collection_name: str) -> List[Dict]:
-    """Отримує всі дані з API для заданої колекції."""
+@contextmanager
+def atomic_write(path: str, permissions: int = 0o644, binary: bool = False):
+    """
+    Відкриває тимчасовий файл поруч із path для запису; після успішного запису
+    робить fsync і атомарно замінює ним path. При помилці path не змінюється,
+    тож обрізаний файл ніколи не потрапить у коміт.
+    binary=True - файл відкривається для запису байтів.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.tmp', dir=directory)
+    try:
+        with (os.fdopen(fd, 'wb') if binary else os.fdopen(fd, 'w', newline='', encoding='utf-8')) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, permissions)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    # Фіксуємо на диску й сам запис перейменування
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class _Http2Response:
+    """Відповідь httpx з інтерфейсом requests.Response, який використовує парсер."""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.content = response.content
+        self.text = response.text
+
+    def json(self):
+        return self._response.json()
+
+    def iter_content(self, chunk_size: int = STREAM_CHUNK_SIZE):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self) -> None:
+        self._response.close()
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+class HttpClient:
+    """
+    Спільний HTTP-клієнт: одна сесія з keep-alive на кожен хост.
+
+    Заголовки за замовчуванням задаються один раз на хост. Якщо увімкнено
+    http2 і встановлено httpx, запити мультиплексуються через HTTP/2.
+    Помилки завжди приводяться до винятків requests.
+
+    Кожен хост має HostGuard (resilience.py): адаптивний обмежувач частоти
+    і запобіжник, тож при 429/5xx клієнт сам пригальмовує.
+
+    recorder записує кожен запит і відповідь; з replayer запити взагалі
+    не йдуть у мережу, а відповіді беруться з запису (traffic.py).
+    """
+
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, http2: bool = HTTP_USE_HTTP2,
+                 recorder: Optional[TrafficRecorder] = None, replayer: Optional[TrafficReplayer] = None):
+        self.pool_size = pool_size
+        self.recorder = recorder
+        self.replayer = replayer
+        self.http2 = http2 and httpx is not None
+        if http2 and httpx is None:
+            print("⚠️ httpx не встановлено, HTTP/2 вимкнено")
+        self._sessions: Dict[str, object] = {}
+        self._default_headers: Dict[str, Dict[str, str]] = {}
+        self._request_counts: Dict[str, int] = {}
+        self._guards: Dict[str, HostGuard] = {}
+        self._lock = threading.Lock()
+
+    def set_default_headers(self, url: str, headers: Dict[str, str]) -> None:
+        """Задає заголовки, що додаються до кожного запиту на хост з url."""
+        host = urlsplit(url).netloc
+        with self._lock:
+            self._default_headers[host] = dict(headers)
+            session = self._sessions.get(host)
+            if session is not None:
+                session.headers.update(headers)
+
+    def _session(self, host: str):
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                if self.http2:
+                    limits = httpx.Limits(max_connections=self.pool_size,
+                                          max_keepalive_connections=self.pool_size)
+                    session = httpx.Client(http2=True, limits=limits)
+                else:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                session.headers.update(self._default_headers.get(host, {}))
+                self._sessions[host] = session
+                self._request_counts[host] = 0
+                self._guards[host] = HostGuard(host)
+            self._request_counts[host] += 1
+            return session
+
+    def get(self, url: str, params: Optional[Dict] = None, headers: Optional[Dict] = None,
+            timeout: float = 10, stream: bool = False):
+        """
+        GET через пул з'єднань хоста.
+        stream=True - тіло читається частинами через iter_content (для HTTP/2 -
+        з уже завантаженої відповіді).
+        """
+        host = urlsplit(url).netloc
+        endpoint = urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1] or host
+        if self.replayer is not None:
+            return self._replay(url, params, headers, endpoint)
+        session = self._session(host)
+        guard = self.guard(host)
+        waited = guard.before_request()
+        if waited >= 0.05:
+            get_metrics().inc('rate_limit_wait_seconds', waited, endpoint=endpoint)
+        started = time.perf_counter()
+        status = 'error'
+        response = None
+        try:
+            if not self.http2:
+                response = session.get(url, params=params, headers=headers, timeout=timeout, stream=stream)
+            else:
+                try:
+                    response = _Http2Response(session.get(url, params=params, headers=headers, timeout=timeout))
+                except httpx.TimeoutException as e:
+                    raise requests.Timeout(str(e)) from e
+                except httpx.HTTPError as e:
+                    raise requests.ConnectionError(str(e)) from e
+            status = response.status_code
+            if self.recorder is not None:
+                self.recorder.record(url, params, headers, response, time.perf_counter() - started)
+            return response
+        except requests.RequestException as e:
+            if self.recorder is not None and response is None:
+                self.recorder.record_error(url, params, headers, e, time.perf_counter() - started)
+            raise
+        finally:
+            get_metrics().observe_request(endpoint, status, time.perf_counter() - started)
+            guard.after_response(response.status_code if response is not None else None,
+                                 retry_after_seconds(response))
+
+    def _replay(self, url: str, params: Optional[Dict], headers: Optional[Dict], endpoint: str):
+        """Відповідь з запису: без мережі й без обмеження частоти."""
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.replayer.get(url, params, headers)
+            status = response.status_code
+            return response
+        finally:
+            get_metrics().observe_request(endpoint, status, time.perf_counter() - started)
+
+    def guard(self, host: str) -> HostGuard:
+        with self._lock:
+            guard = self._guards.get(host)
+            if guard is None:
+                guard = self._guards[host] = HostGuard(host)
+            return guard
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Статистика по хостах: кількість запитів і відкритих з'єднань."""
+        result = {}
+        with self._lock:
+            for host, session in self._sessions.items():
+                connections = 0
+                if isinstance(session, requests.Session):
+                    # http:// і https:// змонтовані на той самий адаптер
+                    adapters = {id(a): a for a in session.adapters.values()}.values()
+                    for adapter in adapters:
+                        pools = adapter.poolmanager.pools
+                        for key in pools.keys():
+                            pool = pools.get(key)
+                            connections += getattr(pool, 'num_connections', 0)
+                result[host] = {'requests': self._request_counts.get(host, 0),
+                                'connections': connections, **self._guards[host].stats()}
+        return result
+
+    def print_stats(self) -> None:
+        if self.replayer is not None:
+            self.replayer.print_stats()
+        for host, stat in self.stats().items():
+            requests_count, connections = stat['requests'], stat['connections']
+            if connections:
+                reused = max(0, requests_count - connections)
+                print(f"🔌 {host}: {requests_count} запитів, {connections} з'єднань "
+                      f"(повторно використано {reused})")
+            else:
+                print(f"🔌 {host}: {requests_count} запитів")
+            if stat['throttled'] or stat['trips']:
+                print(f"   🐢 429/5xx: {stat['throttled']}, розмикань запобіжника: {stat['trips']}, "
+                      f"частота наприкінці {stat['rate']} запитів/с")
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+_http_client: Optional[HttpClient] = None
+_http_client_lock = threading.Lock()
+_recorder: Optional[TrafficRecorder] = None
+_replayer: Optional[TrafficReplayer] = None
+
+
+def get_http_client() -> HttpClient:
+    """Повертає спільний HttpClient (створюється при першому виклику)."""
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient(recorder=_recorder, replayer=_replayer)
+            _http_client.set_default_headers(INVENTORY_API_URL, INVENTORY_HEADERS)
+        return _http_client
+
+
+def configure_traffic(record: Optional[str] = None, replay: Optional[str] = None, timing: str = 'fast') -> None:
+    """
+    Вмикає запис (record - файл) або відтворення (replay - файл) трафіку API
+    для наступних запитів. Без аргументів - вимикає обидва й закриває запис.
+    """
+    global _http_client, _recorder, _replayer
+    with _http_client_lock:
+        if _recorder is not None:
+            _recorder.close()
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
+        _recorder = TrafficRecorder(record) if record else None
+        _replayer = TrafficReplayer(replay, timing) if replay else None
+
+
+def _search_params(collection_name: str, page: int) -> Dict[str, str]:
     collection, handle = collection_name.split('|')
-    all_results = []
-    current_page = 1
+    return {
+        "domain": f"/collections/{collection}",
+        "bgfilter.collection_handle": handle,
+        "resultsFormat": "native",
+        "resultsPerPage": "999",
+        "page": str(page),
+        "bgfilter.ss_is_past_project": "false",
+    }
+
+
+@retry_on_failure(max_attempts=2)
+def open_search_page(collection_name: str, page: int, headers: Optional[Dict[str, str]] = None):
+    """
+    Відкриває сторінку пошуку для потокового читання (повторює лише з'єднання).
+    headers - умовні заголовки (If-None-Match); тоді можлива відповідь 304.
+    """
+    response = get_http_client().get(API_BASE_URL, params=_search_params(collection_name, page),
+                                     headers=headers, timeout=10, stream=True)
+    response.raise_for_status()
+    return response
+
+
+_RESULTS_ARRAY = re.compile(r'"results"\s*:\s*\[')
 
-    # Спочатку отримуємо першу сторінку, щоб дізнатися total_pages
-    while True:
-        params = {
-            "domain": f"/collections/{collection}",
-            "bgfilter.collection_handle": handle,
-            "resultsFormat": "native",
-            "resultsPerPage": "999",
-            "page": str(current_page),
-            "bgfilter.ss_is_past_project": "false",
-            "ts": str(int(time.time() * 1000))
-        }
 
-        response = requests.get(API_BASE_URL, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+def iter_search_results(chunks: Iterable[bytes], meta: Dict, with_raw: bool = False) -> Iterator:
+    """
+    Розбирає відповідь пошуку по мірі надходження байтів і віддає елементи
+    масиву results по одному, не тримаючи в пам'яті всю сторінку.
+    with_raw=True - віддає пари (елемент, його JSON-текст) для хешування.
 
-        results = data.get('results', [])
-        if not results:
+    Після завершення в meta['pagination'] записується pagination відповіді
+    (решта документа без results розбирається звичайним json).
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+
+    def read_more() -> bool:
+        nonlocal buffer
+        for chunk in chunks:
+            if chunk:
+                buffer += text_decoder.decode(chunk)
+                return True
+        buffer += text_decoder.decode(b'', final=True)
+        return False
+
+    # Шукаємо початок масиву results
+    while True:
+        match = _RESULTS_ARRAY.search(buffer)
+        if match:
             break
+        if not read_more():
+            # results немає - розбираємо як є
+            data = json.loads(buffer) if buffer.strip() else {}
+            meta['pagination'] = data.get('pagination', {})
+            for item in data.get('results', []):
+                yield (item, json.dumps(item, sort_keys=True)) if with_raw else item
+            return
 
-        all_results.extend(results)
-        print(f"📥 Сторінка {current_page}: отримано {len(results)} елементів")
+    prefix = buffer[:match.end() - 1]
+    buffer = buffer[match.end():]
+    pos = 0
 
-        # Перевіряємо чи є ще сторінки
-        pagination = data.get('pagination', {})
-        total_pages = pagination.get('totalPages', current_page)
+    while True:
+        # Пропускаємо пробіли та коми між елементами
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer):
+                break
+            if not read_more():
+                raise ValueError("Відповідь пошуку обірвалася посеред results")
 
-        if current_page >= total_pages:
+        if buffer[pos] == ']':
+            pos += 1
             break
 
-        current_page += 1
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Елемент ще не дочитаний
+            if not read_more():
+                raise
+            continue
+
+        yield (item, buffer[pos:end]) if with_raw else item
+        pos = end
+        # Відкидаємо вже розібране, щоб буфер не ріс до розміру сторінки
+        if pos > STREAM_CHUNK_SIZE:
+            buffer = buffer[pos:]
+            pos = 0
+
+    while read_more():
+        pass
+    skeleton = json.loads(prefix + '[]' + buffer[pos:])
+    meta['pagination'] = skeleton.get('pagination', {})
+
+
+def product_from_item(item: Dict) -> Optional[Product]:
+    """Створює Product з елемента пошуку, якщо його категорія в TARGET_CATEGORIES."""
+    category = item.get('tags_category', [])
+
+    # Перевіряємо чи категорія в списку дозволених
+    if category not in TARGET_CATEGORIES:
+        return None
+
+    return Product(
+        car_name=item.get('name', ''),
+        SKU=item.get('sku', ''),
+        page_name=item.get('url', '').split('/')[-1],
+        image_url=remove_url_params(item.get('imageUrl', '')),
+        price=item.get('price', ''),
+        uid=item.get('uid', '')
+    )
 
-    print(f"✅ Всього отримано {len(all_results)} елементів з '{collection}'")
-    return all_results
 
+class CatalogCache:
+    """
+    Кеш каталогу між запусками: хеш кожної сторінки пошуку (та її ETag),
+    поля продуктів, що проходять фільтр, а також зняті з продажу продукти.
+
+    Сторінка, на яку сервер відповів 304, віддається з кешу повністю.
+    Продукт вважається знятим з продажу, якщо його не було в жодній з
+    колекцій, що цього разу прочиталися повністю. Елементи, відкинуті
+    фільтром, не зберігаються. Файл перезаписується лише тоді, коли прохід
+    щось змінив (зміни продуктів, сторінок чи знятих з продажу).
+    """
+
+    def __init__(self, cache_file: str = CATALOG_CACHE_FILE):
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        self._pages: Dict[str, Dict] = {}
+        self._items: Dict[str, Dict] = {}
+        self._removed: Dict[str, Dict] = {}
+        self._dirty = False  # є зміни, яких ще немає у файлі
+        self._load()
+        self.start_run()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('filter') != TARGET_CATEGORIES:
+                return  # фільтр змінився - кешовані рішення фільтра недійсні
+            self._pages = data.get('pages', {})
+            # Старі кеші зберігали й відкинуті фільтром елементи (product = None)
+            self._items = {uid: entry for uid, entry in data.get('items', {}).items()
+                           if entry.get('product') is not None}
+            self._dirty = len(self._items) != len(data.get('items', {}))
+            self._removed = data.get('removed', {})
+        except (IOError, json.JSONDecodeError) as e:
+            print(f"⚠️ Помилка читання кешу каталогу: {e}")
+
+    def start_run(self) -> None:
+        """Починає новий прохід каталогу (для режиму --watch)."""
+        self._seen: set = set()
+        self._complete: set = set()
+        self._page_counts: Dict[str, int] = {}  # колекція → totalPages цього проходу
+        self.changes: Dict[str, List[str]] = {'added': [], 'changed': [], 'removed': []}
+        self.unchanged_pages = 0
+
+    @staticmethod
+    def page_key(collection_name: str, page: int) -> str:
+        return f"{collection_name}#{page}"
+
+    def _count_pages(self, key: str, total_pages: int) -> None:
+        collection_name, _, number = key.rpartition('#')
+        if number == '1':
+            self._page_counts[collection_name] = total_pages
+
+    def page_headers(self, key: str) -> Optional[Dict[str, str]]:
+        """Умовний заголовок для запиту сторінки, якщо відомий її ETag."""
+        etag = self._pages.get(key, {}).get('etag')
+        return {'If-None-Match': etag} if etag else None
+
+    def cached_page(self, collection_name: str, key: str) -> Tuple[List[Product], int]:
+        """Продукти сторінки з кешу (для відповіді 304) і totalPages."""
+        page = self._pages[key]
+        products = []
+        with self._lock:
+            for uid in page['uids']:
+                entry = self._items.get(uid)
+                if entry is None:
+                    continue
+                self._seen.add(uid)
+                if collection_name not in entry['collections']:
+                    entry['collections'].append(collection_name)
+                    self._dirty = True
+                products.append(Product(**entry['product']))
+            self.unchanged_pages += 1
+            self._count_pages(key, page['total_pages'])
+        return products, page['total_pages']
+
+    def product_for(self, collection_name: str, item: Dict) -> Optional[Product]:
+        """Product для елемента пошуку (None - відкинутий фільтром); запам'ятовує його поля."""
+        product = product_from_item(item)
+        uid = str(item.get('uid', ''))
+        if not uid:
+            return product
+
+        fields = None
+        if product is not None:
+            fields = {name: getattr(product, name)
+                      for name in ('car_name', 'SKU', 'page_name', 'image_url', 'price', 'uid')}
+        with self._lock:
+            self._seen.add(uid)
+            previous = self._items.get(uid)
+            if previous is None and fields is None:
+                return product
+            if fields is None:
+                # Продукт більше не проходить фільтр
+                del self._items[uid]
+                self.changes['changed'].append(uid)
+                self._dirty = True
+                return product
+            if previous is None:
+                previous = {'collections': [], 'first_seen': time.time()}
+                self.changes['added'].append(uid)
+                self._dirty = True
+            elif previous['product'] != fields:
+                self.changes['changed'].append(uid)
+                self._dirty = True
+            if collection_name not in previous['collections']:
+                previous['collections'].append(collection_name)
+                self._dirty = True
+            if uid in self._removed:
+                del self._removed[uid]
+                self._dirty = True
+            previous['product'] = fields
+            self._items[uid] = previous
+        return product
+
+    def observe_page(self, key: str, raw_hash: str, uids: List[str], total_pages: int,
+                     etag: Optional[str]) -> bool:
+        """Запам'ятовує сторінку. Повертає True, якщо вона не змінилася."""
+        page = {'hash': raw_hash, 'etag': etag, 'uids': uids, 'total_pages': total_pages}
+        with self._lock:
+            previous = self._pages.get(key, {})
+            unchanged = previous.get('hash') == raw_hash
+            if unchanged:
+                self.unchanged_pages += 1
+            if previous != page:
+                self._pages[key] = page
+                self._dirty = True
+            self._count_pages(key, total_pages)
+        return unchanged
+
+    def mark_complete(self, collection_name: str) -> None:
+        """Колекцію прочитано повністю - її відсутні продукти можна вважати знятими."""
+        with self._lock:
+            self._complete.add(collection_name)
+
+    def finish(self) -> Dict[str, List[str]]:
+        """Визначає зняті з продажу продукти і повертає зміни за прохід."""
+        now = time.time()
+        with self._lock:
+            for uid, entry in list(self._items.items()):
+                if uid in self._seen or not set(entry['collections']) <= self._complete:
+                    continue
+                self._removed[uid] = {**entry['product'], 'collections': entry['collections'],
+                                      'first_seen': entry.get('first_seen'), 'removed_at': now}
+                self.changes['removed'].append(uid)
+                del self._items[uid]
+                self._dirty = True
+            # Сторінки за межею поточної кількості сторінок колекції більше не існують
+            for key in list(self._pages):
+                collection_name, _, number = key.rpartition('#')
+                if (collection_name in self._complete
+                        and int(number) > self._page_counts.get(collection_name, int(number))):
+                    del self._pages[key]
+                    self._dirty = True
+
+        added, changed, removed = (len(self.changes[name]) for name in ('added', 'changed', 'removed'))
+        for name, count in (('added', added), ('changed', changed), ('removed', removed)):
+            get_metrics().inc('catalog_changes', count, change=name)
+        print(f"🧮 Каталог: нових {added}, змінених {changed}, знято з продажу {removed}, "
+              f"незмінених сторінок {self.unchanged_pages}")
+        for uid in self.changes['removed'][:5]:
+            print(f"  ➖ {self._removed[uid]['car_name'][:60]}")
+        return self.changes
+
+    def delisted(self, since: Optional[float] = None) -> List[Dict]:
+        """Зняті з продажу продукти (з часу since), від нещодавніх."""
+        with self._lock:
+            rows = [{'uid': uid, **entry} for uid, entry in self._removed.items()
+                    if since is None or entry['removed_at'] >= since]
+        return sorted(rows, key=lambda row: row['removed_at'], reverse=True)
+
+    def save(self) -> None:
+        """Записує кеш, якщо з останнього запису щось змінилося."""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {'filter': TARGET_CATEGORIES, 'pages': self._pages, 'items': self._items,
+                    'removed': self._removed}
+            try:
+                with atomic_write(self.cache_file) as f:
+                    json.dump(data, f, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+                self._dirty = False
+            except IOError as e:
+                print(f"❌ Помилка запису кешу каталогу: {e}")
+
+
+_STREAM_DONE = object()
+
+
+def stream_catalog(collections: List[str] = COLLECTIONS, max_workers: int = CATALOG_WORKERS,
+                   cache: Optional[CatalogCache] = None) -> Iterator[Product]:
+    """
+    Потоково віддає продукти всіх колекцій по мірі розбору відповідей пошуку.
+
+    Колекції та сторінки читаються паралельно, фільтр TARGET_CATEGORIES
+    застосовується одразу, дублікати між колекціями відкидаються за uid
+    (колекція дописується в Product.collections вже відданого продукту).
+    Черга між читачами та споживачем обмежена, тож пам'ять не росте,
+    якщо запити інвентарю відстають.
+
+    З cache (CatalogCache) сторінки запитуються умовно: незмінену сторінку
+    (304) не потрібно ні завантажувати, ні розбирати.
+    """
+    out: queue.Queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    cancelled = threading.Event()
+
+    def put(message) -> bool:
+        while not cancelled.is_set():
+            try:
+                out.put(message, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce_page(collection_name: str, page: int) -> int:
+        """Читає одну сторінку, повертає totalPages."""
+        collection = collection_name.split('|')[0]
+        key = CatalogCache.page_key(collection_name, page)
+        meta: Dict = {}
+        items = accepted = 0
+        response = open_search_page(collection_name, page, cache.page_headers(key) if cache else None)
+        if response.status_code == 304 and cache is not None:
+            response.close()
+            products, total_pages = cache.cached_page(collection_name, key)
+            for product in products:
+                if not put((collection_name, product)):
+                    return page
+            log_item(f"📥 [{collection}] Сторінка {page} не змінилася: {len(products)} продуктів з кешу")
+            return total_pages
+
+        page_hash = hashlib.blake2b(digest_size=8)
+        uids = []
+        try:
+            for item, raw in iter_search_results(response.iter_content(STREAM_CHUNK_SIZE), meta, with_raw=True):
+                items += 1
+                if cache is not None:
+                    page_hash.update(raw.encode('utf-8'))
+                    product = cache.product_for(collection_name, item)
+                else:
+                    product = product_from_item(item)
+                if product is None:
+                    continue
+                if product.uid:
+                    uids.append(str(product.uid))  # для відповіді 304 потрібні лише продукти, що пройшли фільтр
+                accepted += 1
+                if not put((collection_name, product)):
+                    return page
+        finally:
+            response.close()
+        total_pages = meta.get('pagination', {}).get('totalPages', page) or page
+        if cache is not None:
+            cache.observe_page(key, page_hash.hexdigest(), uids, total_pages, response.headers.get('ETag'))
+        log_item(f"📥 [{collection}] Сторінка {page}: {items} елементів, {accepted} після фільтра")
+        return total_pages
+
+    def produce_collection(collection_name: str) -> None:
+        try:
+            with get_metrics().stage('catalog', collection=collection_name):
+                total_pages = produce_page(collection_name, 1)
+                if total_pages > 1 and not cancelled.is_set():
+                    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pages_executor:
+                        list(pages_executor.map(lambda page: produce_page(collection_name, page),
+                                                range(2, total_pages + 1)))
+            if cache is not None and not cancelled.is_set():
+                cache.mark_complete(collection_name)
+        except Exception as e:
+            print(f"❌ Помилка отримання '{collection_name}': {e}")
+        finally:
+            put(_STREAM_DONE)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='catalog')
+    for collection_name in collections:
+        executor.submit(produce_collection, collection_name)
 
-def process_api_results(results: List[Dict]) -> List[Product]:
-    """Фільтрує та обробляє результати API."""
-    products = []
+    seen: Dict[str, Product] = {}
+    duplicates = 0
+    finished = 0
+    try:
+        while finished < len(collections):
+            message = out.get()
+            if message is _STREAM_DONE:
+                finished += 1
+                continue
+
+            collection_name, product = message
+            key = product.uid or product.page_name
+            existing = seen.get(key)
+            if existing:
+                duplicates += 1
+                if collection_name not in existing.collections:
+                    existing.collections.append(collection_name)
+                continue
+
+            product.collections = [collection_name]
+            seen[key] = product
+            yield product
+    finally:
+        # Споживач міг зупинитися раніше - відпускаємо читачів
+        cancelled.set()
+        executor.shutdown(wait=False)
+
+    if duplicates:
+        print(f"🔗 Об'єднано {duplicates} продуктів, що є в кількох колекціях")
+    print(f"📚 Каталог: {len(seen)} унікальних продуктів")
+
+
+class TokenCache:
+    """
+    Кеш токена на диску з часом отримання і терміном дії.
+
+    Запис іде через тимчасовий файл і os.replace, тому читачі ніколи не бачать
+    частково записаний JSON. Оновлення токена між процесами серіалізується
+    блокуванням окремого .lock файлу (fcntl), щоб токен отримував лише один процес.
+    """
 
-    for item in results:
-        category = item.get('tags_category', [])
+    def __init__(self, cache_file: str = TOKEN_CACHE_FILE):
+        self.cache_file = cache_file
 
-        # Перевіряємо чи категорія в списку дозволених
-        if category in TARGET_CATEGORIES:
-            products.append(Product(
-                car_name=item.get('name', ''),
-                SKU=item.get('sku', ''),
-                page_name=item.get('url', '').split('/')[-1],
-                image_url=remove_url_params(item.get('imageUrl', '')),
-                price=item.get('price', ''),
-                uid=item.get('uid', '')
-            ))
+    @contextmanager
+    def locked(self):
+        """Ексклюзивне блокування кешу між процесами."""
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.cache_file}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-    print(f"🔍 Відфільтровано {len(products)} продуктів")
-    return products
+    def load(self) -> Optional[Dict]:
+        """Повертає {'token', 'obtained_at', 'lifetime'} або None, якщо токен застарів."""
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if time.time() - entry['obtained_at'] < entry['lifetime']:
+                return entry
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def store(self, token: str, obtained_at: float, lifetime: float) -> None:
+        entry = {'token': token, 'obtained_at': obtained_at, 'lifetime': lifetime}
+        try:
+            with atomic_write(self.cache_file, permissions=0o600) as f:
+                json.dump(entry, f)
+        except IOError as e:
+            print(f"⚠️ Не вдалося зберегти токен у кеш: {e}")
 
 
 class TokenManager:
     """Клас для управління токеном авторизації."""
 
-    def __init__(self):
+    def __init__(self, cache_file: Optional[str] = TOKEN_CACHE_FILE,
+                 keep_browser: bool = TOKEN_KEEP_BROWSER, checkout_url: Optional[str] = None):
         self.token: Optional[str] = None
+        self.checkout_url = checkout_url or CHECKOUT_URL  # сторінка вітрини, де перехоплюється токен
         self.token_obtained_at: Optional[float] = None
         self.token_lifetime = 240  # 4 хвилини (токен живе ~5 хв, беремо з запасом)
         self.refresh_attempts = 0
         self.max_refresh_attempts = 3
+        # Один потік оновлює токен, решта чекають на блокуванні
+        self._lock = threading.Lock()
+        self._cache = TokenCache(cache_file) if cache_file else None
+        self.keep_browser = keep_browser
+        # Sync API Playwright прив'язаний до потоку, тому всі виклики браузера
+        # виконуються в одному окремому потоці
+        self._browser_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='playwright')
+        self._playwright = None
+        self._browser: Optional[Browser] = None
+        self._context = None
+        # Фонове оновлення та оцінка реального часу життя токена
+        self._refresher: Optional[threading.Thread] = None
+        self._stop_refresh = threading.Event()
+        self._issued_at: Dict[str, float] = {}  # токен → час отримання (останні кілька)
+        self._min_expired_age: Optional[float] = None  # найменший вік токена з 401
+        self._max_valid_age = 0.0  # найбільший вік токена з успішним запитом
 
     def is_token_valid(self) -> bool:
         """Перевіряє чи токен ще дійсний."""
@@ -171,120 +970,336 @@ class TokenManager:
         elapsed = time.time() - self.token_obtained_at
         return elapsed < self.token_lifetime
 
-    def get_token(self, force_refresh: bool = False) -> Optional[str]:
-        """Отримує токен (з кешу або новий)."""
-        if not force_refresh and self.is_token_valid():
-            elapsed = int(time.time() - self.token_obtained_at)
-            remaining = self.token_lifetime - elapsed
-            print(f"♻️ Використовуємо кешований токен (залишилось ~{remaining}с)")
-            return self.token
-
-        # Перевірка на занадто часті оновлення
-        if self.refresh_attempts >= self.max_refresh_attempts:
-            print(f"❌ Перевищено ліміт оновлень токена ({self.max_refresh_attempts})")
-            return None
+    def _use_cached_token(self, rejected_token: Optional[str]) -> bool:
+        """Бере дійсний токен з дискового кешу, якщо він не той, що відхилено."""
+        if not self._cache:
+            return False
+        entry = self._cache.load()
+        if not entry or entry['token'] == rejected_token:
+            return False
+        self.token_obtained_at = entry['obtained_at']
+        self.token = entry['token']
+        self._remember_issued(self.token, self.token_obtained_at)
+        remaining = int(entry['lifetime'] - (time.time() - entry['obtained_at']))
+        print(f"💾 Токен взято з кешу (залишилось ~{remaining}с)")
+        return True
+
+    def get_token(self, force_refresh: bool = False, stale_token: Optional[str] = None) -> Optional[str]:
+        """
+        Отримує токен (з пам'яті, з кешу на диску або новий).
+
+        stale_token - токен, з яким потік отримав 401 або який застарів.
+        Якщо інший потік уже замінив його на дійсний, повторного оновлення не буде.
+        """
+        with self._lock:
+            if force_refresh and stale_token and self.token != stale_token and self.is_token_valid():
+                return self.token
+
+            if not force_refresh and self.is_token_valid():
+                elapsed = int(time.time() - self.token_obtained_at)
+                remaining = self.token_lifetime - elapsed
+                log_item(f"♻️ Використовуємо кешований токен (залишилось ~{remaining}с)")
+                return self.token
+
+            rejected_token = (stale_token or self.token) if force_refresh else None
+            if self._use_cached_token(rejected_token):
+                return self.token
+
+            # Перевірка на занадто часті оновлення
+            if self.refresh_attempts >= self.max_refresh_attempts:
+                print(f"❌ Перевищено ліміт оновлень токена ({self.max_refresh_attempts})")
+                return None
+
+            self.refresh_attempts += 1
+            print(f"🌐 Отримуємо новий токен (спроба {self.refresh_attempts}/{self.max_refresh_attempts})...")
+
+            cache_lock = self._cache.locked() if self._cache else nullcontext()
+            with cache_lock:
+                # Поки чекали на блокування, токен міг отримати інший процес
+                if self._use_cached_token(rejected_token):
+                    self.refresh_attempts = 0
+                    return self.token
+
+                started = time.perf_counter()
+                with get_metrics().stage('token', source='foreground'):
+                    self.token = self._browser_executor.submit(self._fetch_token_with_playwright).result()
+                get_metrics().observe_token_refresh(time.perf_counter() - started, 'foreground', bool(self.token))
+                if self.token:
+                    self.token_obtained_at = time.time()
+                    self._remember_issued(self.token, self.token_obtained_at)
+                    self.refresh_attempts = 0  # Скидаємо лічильник після успіху
+                    if self._cache:
+                        self._cache.store(self.token, self.token_obtained_at, self.token_lifetime)
+                    print(f"✅ Токен отримано (дійсний ~{self.token_lifetime}с)")
+                else:
+                    print("❌ Не вдалося отримати токен")
 
-        self.refresh_attempts += 1
-        print(f"🌐 Отримуємо новий токен (спроба {self.refresh_attempts}/{self.max_refresh_attempts})...")
+            return self.token
 
-        self.token = self._fetch_token_with_playwright()
-        if self.token:
-            self.token_obtained_at = time.time()
-            self.refresh_attempts = 0  # Скидаємо лічильник після успіху
-            print(f"✅ Токен отримано (дійсний ~{self.token_lifetime}с)")
+    def _remember_issued(self, token: str, obtained_at: float) -> None:
+        self._issued_at[token] = obtained_at
+        # Старі токени потрібні лише поки завершуються запити, що їх використовують
+        for old_token in list(self._issued_at)[:-3]:
+            del self._issued_at[old_token]
+
+    def _update_lifetime(self) -> None:
+        """Перераховує token_lifetime зі спостережень (викликається під блокуванням)."""
+        if self._min_expired_age is not None:
+            lifetime = self._min_expired_age - TOKEN_LIFETIME_SAFETY
+        elif self._max_valid_age > self.token_lifetime:
+            # 401 ще не було, а токен працював довше за оцінку
+            lifetime = self._max_valid_age
         else:
-            print("❌ Не вдалося отримати токен")
+            return
+        lifetime = max(TOKEN_MIN_LIFETIME, lifetime)
+        if int(lifetime) != int(self.token_lifetime):
+            print(f"⏱️ Оцінка часу життя токена: {int(self.token_lifetime)}с → {int(lifetime)}с")
+            self.token_lifetime = lifetime
+
+    def report_success(self, token: str) -> None:
+        """Запит з цим токеном пройшов: токен живе щонайменше стільки."""
+        with self._lock:
+            issued_at = self._issued_at.get(token)
+            if issued_at is None:
+                return
+            age = time.time() - issued_at
+            if age > self._max_valid_age:
+                self._max_valid_age = age
+                self._update_lifetime()
+
+    def report_unauthorized(self, token: str) -> None:
+        """Запит з цим токеном отримав 401: токен живе менше за його поточний вік."""
+        with self._lock:
+            issued_at = self._issued_at.get(token)
+            if issued_at is None:
+                return
+            age = time.time() - issued_at
+            if age >= TOKEN_MIN_LIFETIME and (self._min_expired_age is None or age < self._min_expired_age):
+                self._min_expired_age = age
+                self._update_lifetime()
+
+    def start_background_refresh(self) -> None:
+        """Запускає потік, що отримує новий токен до закінчення поточного."""
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        self._stop_refresh.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name='token-refresh', daemon=True)
+        self._refresher.start()
+
+    def stop_background_refresh(self) -> None:
+        self._stop_refresh.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
+    def _refresh_loop(self) -> None:
+        while not self._stop_refresh.is_set():
+            with self._lock:
+                has_token = bool(self.token and self.token_obtained_at)
+                if has_token:
+                    refresh_at = self.token_obtained_at + self.token_lifetime - TOKEN_REFRESH_MARGIN
+                    delay = max(0.0, refresh_at - time.time())
+
+            # Перший токен отримує основний потік, фоновий лише продовжує його
+            if not has_token:
+                if self._stop_refresh.wait(1):
+                    return
+                continue
 
-        return self.token
+            if self._stop_refresh.wait(delay):
+                return
+            if not self._refresh_in_background():
+                # Не вдалося - повторюємо пізніше, поки працює звичайне оновлення при 401
+                self._stop_refresh.wait(RETRY_DELAY * 5)
+
+    def _refresh_in_background(self) -> bool:
+        """Отримує новий токен без блокування читачів і атомарно підміняє поточний."""
+        started = time.perf_counter()
+        cache_lock = self._cache.locked() if self._cache else nullcontext()
+        with cache_lock:
+            token, obtained_at = None, None
+
+            # Інший процес міг уже отримати свіжіший токен
+            entry = self._cache.load() if self._cache else None
+            if entry and entry['token'] != self.token and \
+                    entry['obtained_at'] + entry['lifetime'] - time.time() > TOKEN_REFRESH_MARGIN:
+                token, obtained_at = entry['token'], entry['obtained_at']
+            else:
+                with get_metrics().stage('token', source='background'):
+                    token = self._browser_executor.submit(self._fetch_token_with_playwright).result()
+                obtained_at = time.time()
+                get_metrics().observe_token_refresh(time.perf_counter() - started, 'background', bool(token))
+                if token and self._cache:
+                    self._cache.store(token, obtained_at, self.token_lifetime)
+
+        if not token:
+            print("⚠️ Фонове оновлення токена не вдалося")
+            return False
+
+        with self._lock:
+            # Спочатку час, потім токен: читач без блокування не побачить
+            # новий токен зі старим часом (і не вирішить, що він застарів)
+            self.token_obtained_at = obtained_at
+            self.token = token
+            self._remember_issued(token, obtained_at)
+            self.refresh_attempts = 0
+        print(f"🔁 Токен оновлено у фоні за {time.perf_counter() - started:.1f}с")
+        return True
+
+    def _ensure_context(self):
+        """Запускає браузер і контекст (або повертає вже запущені)."""
+        if self._context is not None:
+            return self._context
+
+        self._playwright = sync_playwright().start()
+        self._browser = self._playwright.chromium.launch(
+            headless=True,
+            args=[
+                '--no-sandbox',
+                '--disable-setuid-sandbox',
+                '--disable-dev-shm-usage',
+                '--disable-gpu',
+                '--disable-blink-features=AutomationControlled'
+            ]
+        )
+
+        self._context = self._browser.new_context(
+            viewport={'width': 1920, 'height': 1080},
+            user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            bypass_csp=True
+        )
+
+        self._context.add_init_script("""
+            Object.defineProperty(navigator, 'webdriver', { get: () => false });
+            window.chrome = { runtime: {}, app: {}, loadTimes: () => {} };
+        """)
+        return self._context
+
+    def _close_browser(self) -> None:
+        """Закриває браузер і Playwright (виконується в потоці браузера)."""
+        try:
+            if self._browser is not None:
+                self._browser.close()
+            if self._playwright is not None:
+                self._playwright.stop()
+        except Exception as e:
+            print(f"⚠️ Помилка закриття браузера: {e}")
+        finally:
+            self._context = None
+            self._browser = None
+            self._playwright = None
 
     def _fetch_token_with_playwright(self) -> Optional[str]:
-        """Отримує токен авторизації через Playwright."""
+        """
+        Отримує токен авторизації через Playwright.
+        Чекає саме на перехоплений запит до INVENTORY_API_URL з Bearer-токеном.
+        """
+        if _replayer is not None:
+            return 'Bearer replay'  # відповіді з запису, справжній токен не потрібен
+
+        def has_bearer(request) -> bool:
+            if INVENTORY_API_URL not in request.url:
+                return False
+            auth = request.headers.get('authorization') or ''
+            return auth.startswith('Bearer ')
+
+        page = None
         try:
-            with sync_playwright() as p:
-                browser = p.chromium.launch(
-                    headless=True,
-                    args=[
-                        '--no-sandbox',
-                        '--disable-setuid-sandbox',
-                        '--disable-dev-shm-usage',
-                        '--disable-gpu',
-                        '--disable-blink-features=AutomationControlled'
-                    ]
-                )
-
-                context = browser.new_context(
-                    viewport={'width': 1920, 'height': 1080},
-                    user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                    bypass_csp=True
-                )
-
-                context.add_init_script("""
-                    Object.defineProperty(navigator, 'webdriver', { get: () => false });
-                    window.chrome = { runtime: {}, app: {}, loadTimes: () => {} };
-                """)
-
-                page = context.new_page()
-                token = None
-
-                def intercept(route, request):
-                    nonlocal token
-                    if 'mattel-checkout-prd.fly.dev/api/product-inventory' in request.url:
-                        auth = request.headers.get('authorization') or request.headers.get('Authorization')
-                        if auth and auth.startswith('Bearer '):
-                            token = auth
-                            print(f"✅ Токен отримано")
-                    route.continue_()
-
-                page.route('**/*', intercept)
-                page.goto(CHECKOUT_URL, timeout=60000)
-
-                # Чекаємо токен
-                start_time = time.time()
-                while not token and (time.time() - start_time) < TOKEN_WAIT_TIMEOUT:
-                    page.wait_for_timeout(1000)
-
-                browser.close()
-                return token
+            page = self._ensure_context().new_page()
+            # Очікування покриває і завантаження сторінки, і запит інвентарю
+            timeout_ms = 60000 + TOKEN_WAIT_TIMEOUT * 1000
+            with page.expect_request(has_bearer, timeout=timeout_ms) as request_info:
+                page.goto(self.checkout_url, timeout=60000)
+            token = request_info.value.headers.get('authorization')
+            print(f"✅ Токен отримано")
+            return token
 
         except Exception as e:
             print(f"❌ Помилка Playwright: {e}")
             return None
 
+        finally:
+            if page is not None and self.keep_browser:
+                try:
+                    page.close()
+                except Exception:
+                    pass
+            if not self.keep_browser:
+                self._close_browser()
+
+    def close(self) -> None:
+        """Зупиняє фонове оновлення, закриває теплий браузер і потік Playwright."""
+        self.stop_background_refresh()
+        self._browser_executor.submit(self._close_browser).result()
+        self._browser_executor.shutdown(wait=True)
 
-def get_item_inventory(token: str, product_id: str) -> Tuple[int, int, bool]:
+
+class BatchSizer:
     """
-    Отримує інформацію про інвентар продукту.
+    Підбирає найбільший розмір пакета, який приймає сервер.
 
-    Returns:
-        (max_qty, current_qty, success)
-        max_qty - максимальна кількість з variant_inventory (що була відома)
-        current_qty - totalInventory (скільки залишилось зараз, може бути від'ємним)
-    """
-    headers = {
-        "Authorization": token,
-        "Accept": "application/json",
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
-        "Origin": "https://extensions.shopifycdn.com",
-        "Referer": "https://extensions.shopifycdn.com/",
-    }
+    Поки сервер нічого не відхиляв, розмір після успішного запиту
+    подвоюється. Далі межа шукається бінарним пошуком між найбільшим
+    прийнятим розміром (floor) і найменшим відхиленим (ceiling), тож
+    відхилень логарифмічно мало. Тимчасові помилки (5xx, таймаути)
+    розміру не стосуються і його не змінюють.
+    """
 
-    params = {"productIds": f"gid://shopify/Product/{product_id}"}
+    def __init__(self, initial: int = INVENTORY_BATCH_SIZE, maximum: int = INVENTORY_BATCH_MAX):
+        self.maximum = maximum
+        self.size = max(1, min(initial, maximum))
+        self.floor = 0  # найбільший розмір, який сервер прийняв
+        self.ceiling = maximum + 1  # найменший розмір, який сервер відхилив
+        self.rejections = 0
+        self._lock = threading.Lock()
+
+    def record_success(self, batch_size: int) -> None:
+        with self._lock:
+            self.floor = max(self.floor, min(batch_size, self.ceiling - 1))
+            if batch_size < self.size:
+                return  # неповний пакет (кінець черги або половина відхиленого) нічого не каже про межу
+            if self.ceiling > self.maximum:
+                target = self.size * 2
+            else:
+                target = (self.floor + self.ceiling) // 2
+            self.size = max(1, self.floor, min(target, self.ceiling - 1))
+
+    def record_rejection(self, batch_size: int) -> None:
+        with self._lock:
+            if batch_size <= 1:
+                return
+            self.rejections += 1
+            if batch_size <= self.floor:
+                self.floor = 0  # сервер зменшив межу - прийняті раніше розміри вже не гарантовані
+            self.ceiling = min(self.ceiling, batch_size)
+            self.size = max(1, (self.floor + self.ceiling) // 2)
+
+    def disable(self) -> bool:
+        """Далі лише по одному продукту. Повертає True, якщо пакети ще були ввімкнені."""
+        with self._lock:
+            enabled = self.ceiling > 2
+            self.size, self.floor, self.ceiling = 1, 1, 2
+            return enabled
+
+
+class InventoryIdsMissing(ValueError):
+    """Елементи пакетної відповіді інвентарю без id: їх не зіставити з запитаними продуктами."""
+
+
+def _product_id_from_gid(gid) -> str:
+    """gid://shopify/Product/123 → 123."""
+    if not gid or not isinstance(gid, str):
+        return ''
+    return gid.rsplit('/', 1)[-1]
 
-    try:
-        resp = requests.get(INVENTORY_API_URL, headers=headers, params=params, timeout=15)
-        resp.raise_for_status()
-        data = resp.json()
-    except requests.HTTPError as e:
-        # Пробрасываем HTTPError наверх для обработки 401
-        raise
-    except Exception as e:
-        print(f"⚠️ Помилка запиту для {product_id}: {e}")
-        return 0, 0, False
 
-    if not data or not isinstance(data, list) or len(data) == 0:
-        return 0, 0, True  # Порожній інвентар - це не помилка
+def _parse_inventory_item(item: Dict) -> Tuple[int, int]:
+    """
+    Розбирає один елемент відповіді інвентарю.
 
-    item = data[0]
+    Returns:
+        (max_qty, current_qty)
+    """
     # totalInventory = скільки залишилось (може бути від'ємним)
     total_inventory = item.get("totalInventory", 0) or 0
 
@@ -292,16 +1307,16 @@ def get_item_inventory(token: str, product_id: str) -> Tuple[int, int, bool]:
     variant_meta = item.get("variantMeta")
     if not variant_meta or not variant_meta.get("value"):
         # Якщо немає варіантів, max_qty невідомий (0)
-        return 0, int(total_inventory), True
+        return 0, int(total_inventory)
 
     try:
         parsed = json.loads(variant_meta["value"])
         if not parsed or not isinstance(parsed, list):
-            return 0, int(total_inventory), True
+            return 0, int(total_inventory)
 
         variant_inventory = parsed[0].get("variant_inventory", [])
     except (TypeError, json.JSONDecodeError, IndexError, KeyError):
-        return 0, int(total_inventory), True
+        return 0, int(total_inventory)
 
     # Шукаємо максимальну кількість з варіантів
     # Пріоритет: Available → Backordered
@@ -322,91 +1337,291 @@ def get_item_inventory(token: str, product_id: str) -> Tuple[int, int, bool]:
                 break
 
     # Повертаємо (max_qty з варіантів, current_qty з totalInventory)
-    return max_qty, int(total_inventory), True
+    return max_qty, int(total_inventory)
+
+
+@retry_on_failure(retry_if=is_transient)
+def get_items_inventory(token: str, product_ids: List[str]) -> Dict[str, Tuple[int, int]]:
+    """
+    Отримує інвентар кількох продуктів одним запитом.
+    Тимчасові помилки (таймаути, 429, 5xx) повторюються з затримкою.
+
+    Returns:
+        {product_id: (max_qty, current_qty)} - тільки для продуктів, що є у відповіді.
+        Помилки запиту (HTTPError, таймаути) пробрасуються наверх; якщо в пакетній
+        відповіді елементи без id - InventoryIdsMissing.
+    """
+    # Решта заголовків (INVENTORY_HEADERS) задана в сесії хоста
+    headers = {"Authorization": token}
+    params = {"productIds": ",".join(f"gid://shopify/Product/{pid}" for pid in product_ids)}
+
+    resp = get_http_client().get(INVENTORY_API_URL, headers=headers, params=params, timeout=15)
+    resp.raise_for_status()
+    data = resp.json()
+
+    if not data or not isinstance(data, list):
+        return {}
+    items = [item for item in data if isinstance(item, dict)]
+
+    # Для одного продукту ідентифікатор у відповіді не потрібен
+    if len(product_ids) == 1:
+        return {product_ids[0]: _parse_inventory_item(items[0])} if items else {}
+
+    # Без id невідомо, якому продукту належить елемент (порядок відповіді не гарантований)
+    if any(not _product_id_from_gid(item.get("id")) for item in items):
+        raise InventoryIdsMissing(f"у відповіді на {len(product_ids)} продуктів є елементи без id")
+
+    wanted = set(product_ids)
+    inventory = {}
+    for item in items:
+        item_id = _product_id_from_gid(item.get("id"))
+        if item_id in wanted:
+            inventory[item_id] = _parse_inventory_item(item)
+    return inventory
+
+
+def fetch_inventory_batched(token: str, product_ids: List[str],
+                            sizer: BatchSizer) -> Tuple[Dict[str, Tuple[int, int]], Dict[str, Exception]]:
+    """
+    Отримує інвентар пакетами, розбиваючи пакет навпіл при помилці.
+
+    Returns:
+        (inventory, errors)
+        inventory - {product_id: (max_qty, current_qty)}
+        errors - {product_id: exception} для продуктів, що не вдалося отримати поодинці
+    401 пробрасується одразу, щоб викликач оновив токен, CircuitOpenError - щоб зупинився.
+    """
+    inventory: Dict[str, Tuple[int, int]] = {}
+    errors: Dict[str, Exception] = {}
+    pending = [list(product_ids)]
+
+    while pending:
+        batch = pending.pop()
+        try:
+            found = get_items_inventory(token, batch)
+        except InventoryIdsMissing as e:
+            # Ділити навпіл марно (2N-1 запитів): одразу запитуємо по одному
+            if sizer.disable():
+                print(f"⚠️ Пакетні запити інвентарю вимкнено: {e}. Далі по одному продукту")
+            pending.extend([pid] for pid in reversed(batch))
+            continue
+        except CircuitOpenError:
+            raise
+        except requests.RequestException as e:
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code == 401:
+                raise
+            if len(batch) == 1:
+                errors[batch[0]] = e
+                continue
+            # Навпіл ділиться будь-який невдалий пакет (щоб відокремити проблемні продукти),
+            # але стеля розміру знижується лише тоді, коли сервер відхилив сам розмір
+            if response is not None and response.status_code in BATCH_REJECT_STATUSES:
+                sizer.record_rejection(len(batch))
+            middle = len(batch) // 2
+            log_item(f"✂️ Пакет з {len(batch)} продуктів не пройшов, ділимо навпіл")
+            pending.extend([batch[middle:], batch[:middle]])
+            continue
+
+        sizer.record_success(len(batch))
+        inventory.update(found)
+
+        missing = [pid for pid in batch if pid not in found]
+        if not missing:
+            continue
+        if len(batch) == 1:
+            inventory[batch[0]] = (0, 0)  # Порожній інвентар - це не помилка
+        elif len(missing) < len(batch):
+            pending.append(missing)
+        else:
+            middle = len(batch) // 2
+            pending.extend([batch[middle:], batch[:middle]])
+
+    return inventory, errors
 
 
-def update_products_qty(products: List[Product], token_manager: TokenManager) -> Tuple[List[Product], bool]:
+def update_products_qty(products: Iterable[Product], token_manager: TokenManager,
+                        max_workers: int = MAX_WORKERS,
+                        on_updated: Optional[Callable[[Product], None]] = None,
+                        on_failed: Optional[Callable[[Product, str], None]] = None,
+                        cancel: Optional[threading.Event] = None,
+                        sizer: Optional[BatchSizer] = None) -> Tuple[List[Product], bool]:
     """
     Оновлює кількість для кожного продукту.
-    Повертає (оновлений_список, success_flag)
+    Продукти запитуються пакетами (див. BatchSizer), пакети обробляються
+    паралельно, не більше max_workers одночасно. sizer - щоб підібраний
+    розмір пакета зберігся між викликами (інакше підбір починається заново).
+
+    products може бути і генератором (див. stream_catalog): продукти беруться
+    по мірі надходження, а on_updated викликається (з потоку воркера) для
+    кожного продукту одразу після отримання його інвентарю. on_failed(product, reason)
+    викликається для продуктів, інвентар яких отримати не вдалося. Після
+    cancel.set() воркери завершують поточні пакети і зупиняються.
+
+    Повертає (оновлений_список, success_flag); для генератора список порожній.
     success_flag = False, якщо були проблеми (наприклад, 500-помилки).
+    Частоту запитів і паузи при 500-помилках регулює HttpClient (HostGuard);
+    оновлення зупиняється, лише коли запобіжник хоста здався.
     """
+    result = products if isinstance(products, list) else []
     token = token_manager.get_token()
     if not token:
         print("❌ Токен відсутній, пропускаємо оновлення")
-        return products, False
+        return result, False
 
     failed_products = []
-    consecutive_500_errors = 0
-    MAX_500_ERRORS = 3
     had_server_errors = False
-
-    for i, product in enumerate(products, 1):
-        if not product.uid:
-            print(f"⏭️ [{i}/{len(products)}] Пропущено {product.car_name[:40]}: немає UID")
-            continue
-
-        print(f"🔄 [{i}/{len(products)}] {product.car_name[:50]}...")
-
-        # Перевірка дійсності токена
+    aborted_on_500 = False
+
+    state_lock = threading.Lock()
+    stop_event = threading.Event()
+    sizer = sizer or BatchSizer()
+    source = enumerate(products, 1)
+    source_lock = threading.Lock()  # окреме блокування: читання генератора може чекати на мережу
+    total = len(products) if hasattr(products, '__len__') else '?'
+
+    def next_batch() -> List[Tuple[int, Product]]:
+        with source_lock:
+            batch = []
+            while len(batch) < sizer.size:
+                next_item = next(source, None)
+                if next_item is None:
+                    break
+                i, product = next_item
+                if not product.uid:
+                    log_item(f"⏭️ [{i}/{total}] Пропущено {product.car_name[:40]}: немає UID")
+                    continue
+                batch.append((i, product))
+            return batch
+
+    def apply_inventory(product: Product, max_qty: int, current_qty: int) -> None:
+        product.max_qty = max_qty
+        product.current_qty = current_qty
+        product.checked_at = time.time()
+        if on_updated is not None:
+            on_updated(product)
+
+    def mark_failed(product: Product, reason: str = 'error') -> None:
+        with state_lock:
+            failed_products.append(product.car_name)
+        if on_failed is not None:
+            on_failed(product, reason)
+
+    def stop_with_server_error() -> None:
+        nonlocal had_server_errors
+        with state_lock:
+            had_server_errors = True
+        stop_event.set()
+
+    def record_500(product: Product) -> None:
+        nonlocal had_server_errors
+        with state_lock:
+            had_server_errors = True
+        mark_failed(product, 'HTTP 500')
+        log_item(f"⚠️ HTTP 500 для {product.uid}")
+
+    def abort_on_open_circuit(batch: List[Tuple[int, Product]], error: Exception) -> None:
+        nonlocal had_server_errors, aborted_on_500
+        for _, product in batch:
+            mark_failed(product, 'circuit open')
+        with state_lock:
+            had_server_errors = True
+            first_abort = not aborted_on_500
+            aborted_on_500 = True
+        stop_event.set()
+        if first_abort:
+            print(f"⛔ {error}")
+
+    def process(batch: List[Tuple[int, Product]]) -> None:
+        first, last = batch[0][0], batch[-1][0]
+        log_item(f"🔄 [{first}-{last}/{total}] пакет з {len(batch)} продуктів...")
+
+        by_uid: Dict[str, List[Product]] = {}
+        for _, product in batch:
+            by_uid.setdefault(product.uid, []).append(product)
+        uids = list(by_uid)
+
+        # Перевірка дійсності токена (при фоновому оновленні він уже свіжий)
+        token = token_manager.token
         if not token_manager.is_token_valid():
             print("⏰ Токен застарів, оновлюємо превентивно...")
-            token = token_manager.get_token(force_refresh=True)
+            token = token_manager.get_token()
             if not token:
                 print("❌ Не вдалося оновити токен, припиняємо обробку")
-                had_server_errors = True
-                break
+                stop_with_server_error()
+                return
 
         try:
-            max_qty, current_qty, success = get_item_inventory(token, product.uid)
-            if success:
-                consecutive_500_errors = 0
-                product.max_qty = max_qty
-                product.current_qty = current_qty
-
-        except requests.exceptions.HTTPError as e:
-            status = e.response.status_code
-
-            if status == 401:
-                print("🔄 401 Unauthorized - оновлюємо токен...")
-                token = token_manager.get_token(force_refresh=True)
-                if token:
-                    try:
-                        max_qty, current_qty, success = get_item_inventory(token, product.uid)
-                        if success:
-                            consecutive_500_errors = 0
-                            product.max_qty = max_qty
-                            product.current_qty = current_qty
-                        else:
-                            failed_products.append(product.car_name)
-                    except Exception as retry_e:
-                        print(f"❌ Повторна спроба невдала: {retry_e}")
-                        failed_products.append(product.car_name)
-                else:
-                    print("❌ Не вдалося оновити токен, припиняємо")
-                    had_server_errors = True
-                    break
-
-            elif status == 500:
-                consecutive_500_errors += 1
-                had_server_errors = True
-                print(f"⚠️ HTTP 500 для {product.uid} ({consecutive_500_errors}/{MAX_500_ERRORS})")
+            inventory, errors = fetch_inventory_batched(token, uids, sizer)
+            token_manager.report_success(token)
 
-                if consecutive_500_errors >= MAX_500_ERRORS:
-                    print("\n⚠️ Надто багато помилок 500 — здається, API Mattel не працює стабільно.")
-                    print("⛔ Припиняємо оновлення кількості та не будемо змінювати CSV.")
-                    return products, False  # припиняємо одразу
-                continue  # не оновлюємо кількість після 500
+        except CircuitOpenError as e:
+            abort_on_open_circuit(batch, e)
+            return
 
-            else:
-                consecutive_500_errors = 0
-                failed_products.append(product.car_name)
-                print(f"❌ HTTP {status} для {product.uid}")
+        except requests.exceptions.HTTPError:
+            # fetch_inventory_batched пробрасує лише 401
+            print("🔄 401 Unauthorized - оновлюємо токен...")
+            token_manager.report_unauthorized(token)
+            token = token_manager.get_token(force_refresh=True, stale_token=token)
+            if not token:
+                print("❌ Не вдалося оновити токен, припиняємо")
+                stop_with_server_error()
+                return
+            try:
+                inventory, errors = fetch_inventory_batched(token, uids, sizer)
+            except CircuitOpenError as retry_e:
+                abort_on_open_circuit(batch, retry_e)
+                return
+            except Exception as retry_e:
+                print(f"❌ Повторна спроба невдала: {retry_e}")
+                for _, product in batch:
+                    mark_failed(product, 'unauthorized')
+                return
 
         except Exception as e:
-            consecutive_500_errors = 0
-            failed_products.append(product.car_name)
-            print(f"⚠️ Несподівана помилка для {product.uid}: {e}")
+            for _, product in batch:
+                mark_failed(product)
+            print(f"⚠️ Несподівана помилка для пакета [{first}-{last}]: {e}")
+            return
+
+        for uid, (max_qty, current_qty) in inventory.items():
+            for product in by_uid[uid]:
+                apply_inventory(product, max_qty, current_qty)
+
+        for uid, error in errors.items():
+            response = getattr(error, 'response', None)
+            status = response.status_code if response is not None else None
+            for product in by_uid[uid]:
+                if status == 500:
+                    record_500(product)
+                elif status is not None:
+                    mark_failed(product, f'HTTP {status}')
+                    log_item(f"❌ HTTP {status} для {uid}")
+                else:
+                    mark_failed(product)
+                    log_item(f"⚠️ Несподівана помилка для {uid}: {error}")
+
+    def worker() -> None:
+        try:
+            while not stop_event.is_set() and not (cancel is not None and cancel.is_set()):
+                batch = next_batch()
+                if not batch:
+                    return
+                process(batch)
+        except BaseException:
+            stop_event.set()  # збій одного воркера зупиняє всіх; збережене лишається в маніфесті
+            raise
+
+    workers = max(1, max_workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(worker) for _ in range(workers)]:
+            future.result()
+
+    if aborted_on_500:
+        print("\n⚠️ Надто багато помилок 500 — здається, API Mattel не працює стабільно.")
+        print("⛔ Припиняємо оновлення кількості.")
+        return result, False
 
     if failed_products:
         print(f"\n⚠️ Не вдалося оновити {len(failed_products)} продуктів.")
@@ -415,83 +1630,225 @@ def update_products_qty(products: List[Product], token_manager: TokenManager) ->
         if len(failed_products) > 5:
             print(f"  ... та ще {len(failed_products) - 5}")
 
-    return products, not had_server_errors
+    print(f"📦 Розмір пакета після підбору: {sizer.size}")
+    return result, not had_server_errors
 
 
-class CSVManager:
-    """Клас для роботи з CSV файлом."""
+_shard_token_manager: Optional[TokenManager] = None
+_shard_sizer: Optional[BatchSizer] = None  # розмір пакета, підібраний воркером, живе між завданнями
 
-    def __init__(self, csv_file: str = 'output.csv'):
-        self.csv_file = csv_file
-        self._cache: Optional[List[Product]] = None
 
-    def remove_duplicates(self) -> int:
-        """Видаляє дублікати з CSV файлу. Повертає кількість видалених дублікатів."""
-        products = self._load_cache()
-        original_count = len(products)
+def _init_shard_worker(endpoints: Dict[str, str], rate_share: float, quiet: bool) -> None:
+    """Ініціалізація процесу-воркера: адреси вітрини, частка частоти, режим виводу координатора."""
+    global API_BASE_URL, INVENTORY_API_URL, CHECKOUT_URL, QUIET
+    API_BASE_URL = endpoints['search_url']
+    INVENTORY_API_URL = endpoints['inventory_url']
+    CHECKOUT_URL = endpoints['checkout_url']
+    QUIET = quiet
+    resilience.RATE_SHARE = rate_share
+    get_http_client().set_default_headers(INVENTORY_API_URL, INVENTORY_HEADERS)
 
-        # Використовуємо словник для відстеження унікальних продуктів
-        # Ключ: (page_name, car_name, SKU)
-        unique_products = {}
 
+def _update_shard(products: List[Product],
+                  token_cache_file: str) -> Tuple[List[Product], List[Tuple[Product, str]], bool, str]:
+    """
+    Завдання воркера: інвентар для частини продуктів. Токен - зі спільного кешу.
+    Вивід повертається координатору, який друкує його у свій stdout.
+    """
+    global _shard_token_manager, _shard_sizer
+    if _shard_token_manager is None:
+        _shard_token_manager = TokenManager(token_cache_file)
+    if _shard_sizer is None:
+        _shard_sizer = BatchSizer()
+    updated: List[Product] = []
+    failed: List[Tuple[Product, str]] = []
+    output = io.StringIO()
+    with redirect_stdout(output):
+        _, success = update_products_qty(products, _shard_token_manager, on_updated=updated.append,
+                                         on_failed=lambda product, reason: failed.append((product, reason)),
+                                         sizer=_shard_sizer)
+    return updated, failed, success, output.getvalue()
+
+
+def update_products_qty_sharded(products: Iterable[Product], token_manager: TokenManager,
+                                processes: int = PROCESSES,
+                                on_updated: Optional[Callable[[Product], None]] = None,
+                                on_failed: Optional[Callable[[Product, str], None]] = None,
+                                cancel: Optional[threading.Event] = None) -> Tuple[List[Product], bool]:
+    """
+    Варіант update_products_qty для кількох процесів.
+
+    Продукти ріжуться на завдання по SHARD_CHUNK_SIZE у порядку надходження.
+    Кожен процес має власний HttpClient і частку частоти запитів
+    (resilience.RATE_SHARE = 1 / processes); токен спільний через файл
+    кешу TokenManager, тож браузер запускає лише один процес.
+    Результати застосовуються (on_updated / on_failed) у цьому процесі в
+    порядку завдань, а не завершення, тож злиття детерміноване.
+    """
+    # Токен отримує координатор: воркери знайдуть його в кеші
+    if not token_manager.get_token():
+        print("❌ Токен відсутній, пропускаємо оновлення")
+        return [], False
+    if token_manager._cache is None or _recorder is not None or _replayer is not None:
+        print("⚠️ Без кешу токена (або із записом/відтворенням трафіку) працюємо в одному процесі")
+        return update_products_qty(products, token_manager, on_updated=on_updated,
+                                   on_failed=on_failed, cancel=cancel)
+
+    endpoints = {'search_url': API_BASE_URL, 'inventory_url': INVENTORY_API_URL,
+                 'checkout_url': token_manager.checkout_url}
+    success = True
+    total = 0
+
+    def merge(future) -> None:
+        nonlocal success, total
+        updated, failed, shard_success, output = future.result()
+        print(output, end='')
+        success = success and shard_success
+        total += len(updated)
+        for product in updated:
+            if on_updated is not None:
+                on_updated(product)
+        for product, reason in failed:
+            if on_failed is not None:
+                on_failed(product, reason)
+
+    # spawn, а не fork: у батьківському процесі вже працюють потоки (токен, пули)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_shard_worker,
+                             initargs=(endpoints, 1 / processes, QUIET)) as pool:
+        in_flight: deque = deque()
+        chunk: List[Product] = []
         for product in products:
-            key = (product.page_name, product.car_name, product.SKU)
-
-            if key in unique_products:
-                existing = unique_products[key]
-
-                # При дублікатах:
-                # - current_qty: беремо МЕНШЕ (товари розкуповують), але мінімум 0
-                # - max_qty: беремо БІЛЬШЕ (максимальна кількість, що була)
-                # - image_url, price: беремо непорожні
-
-                merged_current_qty = min(existing.current_qty, product.current_qty)
-                # Якщо кількість від'ємна - ставимо 0
-                if merged_current_qty < 0:
-                    merged_current_qty = 0
-
-                merged = Product(
-                    car_name=product.car_name,
-                    SKU=product.SKU,
-                    page_name=product.page_name,
-                    image_url=existing.image_url or product.image_url,
-                    price=existing.price or product.price,
-                    uid=product.uid or existing.uid,
-                    max_qty=max(existing.max_qty, product.max_qty),
-                    current_qty=merged_current_qty
-                )
-
-                unique_products[key] = merged
-            else:
-                # Нормалізуємо й для нових продуктів
-                if product.current_qty < 0:
-                    product.current_qty = 0
-                unique_products[key] = product
+            chunk.append(product)
+            if len(chunk) >= SHARD_CHUNK_SIZE:
+                in_flight.append(pool.submit(_update_shard, chunk, token_manager._cache.cache_file))
+                chunk = []
+            # Не більше двох завдань на процес наперед, щоб пам'ять не росла
+            while len(in_flight) > processes * 2:
+                merge(in_flight.popleft())
+            if cancel is not None and cancel.is_set():
+                break
+        if chunk and not (cancel is not None and cancel.is_set()):
+            in_flight.append(pool.submit(_update_shard, chunk, token_manager._cache.cache_file))
+        while in_flight:
+            merge(in_flight.popleft())
+
+    print(f"🧩 {processes} процесів оновили {total} продуктів")
+    return [], success
+
 
-        # Оновлюємо кеш унікальними продуктами
-        self._cache = list(unique_products.values())
-        duplicates_removed = original_count - len(self._cache)
+class CSVManager:
+    """
+    Клас для роботи з CSV файлом.
+
+    Продукти зберігаються з первинним індексом (page_name, car_name, SKU)
+    та вторинними індексами за SKU і uid. Дублікати зливаються одразу при
+    завантаженні, тому унікальність ключа гарантується завжди. Вторинні
+    індекси знаходять той самий продукт під іншим ключем (змінилися назва
+    чи адреса сторінки): такий запис перейменовується, а не дублюється.
+
+    Змінені записи позначаються як "брудні": save() пише файл лише якщо вони
+    є, а write_delta() зберігає зміни поточного запуску окремим файлом.
+    Кожне злиття також дає типізовані події (feed.stock_events), які
+    забираються через drain_events() для стрічки змін, і, якщо підключено
+    ProductIndex (attach_index), одразу оновлює індекси сервісу запитів.
+    """
 
-        if duplicates_removed > 0:
-            print(f"🧹 Видалено {duplicates_removed} дублікатів ({original_count} → {len(self._cache)})")
+    def __init__(self, csv_file: str = 'output.csv'):
+        self.csv_file = csv_file
+        self._cache: Optional[List[Product]] = None
+        self._index: Dict[Tuple[str, str, str], Product] = {}
+        self._by_sku: Dict[str, List[Product]] = {}
+        self._by_uid: Dict[str, Product] = {}
+        self._duplicates_merged = 0
+        self._dirty = False  # є зміни, яких ще немає у файлі
+        self._run_changes: Dict[Tuple[str, str, str], str] = {}  # ключ → 'added' / 'updated'
+        self._events: List[Dict] = []  # події, ще не записані у стрічку змін
+        self._query_index: Optional[ProductIndex] = None
+
+    @staticmethod
+    def _merge_duplicate(existing: Product, product: Product) -> None:
+        """
+        Зливає дублікат в існуючий запис:
+        - current_qty: беремо МЕНШЕ (товари розкуповують), але мінімум 0
+        - max_qty: беремо БІЛЬШЕ (максимальна кількість, що була)
+        - image_url, price: беремо непорожні
+        """
+        existing.current_qty = max(0, min(existing.current_qty, product.current_qty))
+        existing.max_qty = max(existing.max_qty, product.max_qty)
+        existing.image_url = existing.image_url or product.image_url
+        existing.price = existing.price or product.price
+        existing.uid = product.uid or existing.uid
+
+    def _index_uid(self, product: Product) -> None:
+        if product.uid:
+            self._by_uid[product.uid] = product
+
+    def _insert(self, product: Product) -> bool:
+        """Додає продукт в індекси. Повертає False, якщо це був дублікат."""
+        existing = self._index.get(product.key)
+        if existing is None and product.uid:
+            existing = self._by_uid.get(product.uid)  # той самий продукт, збережений під старою назвою
+        if existing is not None:
+            self._merge_duplicate(existing, product)
+            self._index_uid(existing)
+            return False
 
-        return duplicates_removed
+        # Нормалізуємо й для нових продуктів
+        if product.current_qty < 0:
+            product.current_qty = 0
+        self._cache.append(product)
+        self._index[product.key] = product
+        self._by_sku.setdefault(product.SKU, []).append(product)
+        self._index_uid(product)
+        return True
+
+    def _rekey(self, product: Product, renamed: Product) -> None:
+        """Переносить запис під ключ renamed (назва, адреса сторінки, SKU) в усіх індексах."""
+        old_key = product.key
+        del self._index[old_key]
+        self._by_sku[product.SKU].remove(product)
+        if self._query_index is not None:
+            self._query_index.remove(old_key)
+        product.car_name, product.page_name, product.SKU = renamed.car_name, renamed.page_name, renamed.SKU
+        self._index[product.key] = product
+        self._by_sku.setdefault(product.SKU, []).append(product)
+        if old_key in self._run_changes:
+            self._run_changes[product.key] = self._run_changes.pop(old_key)
+
+    def remove_duplicates(self) -> int:
+        """
+        Повертає кількість дублікатів, злитих при завантаженні CSV.
+        Окремий прохід не потрібен: індекс не допускає дублікатів.
+        """
+        self._load_cache()
+        return self._duplicates_merged
 
     def _load_cache(self) -> List[Product]:
         """Завантажує існуючі дані з CSV у пам'ять."""
         if self._cache is not None:
             return self._cache
 
-        products = []
+        self._cache = []
+        self._index.clear()
+        self._by_sku.clear()
+        self._by_uid.clear()
+        self._duplicates_merged = 0
 
         if os.path.exists(self.csv_file) and os.path.getsize(self.csv_file) > 0:
             try:
                 with open(self.csv_file, 'r', newline='', encoding='utf-8') as f:
-                    reader = csv.DictReader(f)
+                    reader = csv.reader(f)
+                    header = next(reader, [])
+                    # Рядки читаються як списки за позиціями стовпців: без словника на рядок.
+                    # Відсутній стовпець (у старих CSV немає uid) або короткий рядок - порожні значення
+                    positions = [header.index(name) if name in header else len(header) for name in CSV_FIELDNAMES]
                     for row in reader:
+                        car_name, sku, page_name, max_qty, current_qty, image_url, price, uid = (
+                            row[i] if i < len(row) else '' for i in positions)
                         try:
-                            max_qty = int(row.get('max_qty', 0) or 0)
-                            current_qty = int(row.get('current_qty', 0) or 0)
+                            max_qty = int(max_qty or 0)
+                            current_qty = int(current_qty or 0)
 
                             # Нормалізація від'ємних значень
                             # max_qty може бути від'ємним (totalInventory від API)
@@ -499,124 +1856,739 @@ class CSVManager:
                             if current_qty < 0:
                                 current_qty = 0
 
-                            products.append(Product(
-                                car_name=row.get('car_name', ''),
-                                SKU=row.get('SKU', ''),
-                                page_name=row.get('page_name', ''),
-                                image_url=row.get('image_url', ''),
-                                price=row.get('price', ''),
-                                uid='',  # UID не зберігається в CSV
+                            product = Product(
+                                car_name=car_name,
+                                SKU=sku,
+                                page_name=page_name,
+                                image_url=image_url,
+                                price=sys.intern(price),  # різних цін небагато - один рядок на значення
+                                uid=uid,
                                 max_qty=max_qty,
                                 current_qty=current_qty
-                            ))
+                            )
                         except (ValueError, TypeError) as e:
                             print(f"⚠️ Помилка парсингу рядка CSV: {e}, рядок: {row}")
                             continue
+
+                        if not self._insert(product):
+                            self._duplicates_merged += 1
             except Exception as e:
                 print(f"⚠️ Помилка читання CSV: {e}")
 
-        self._cache = products
-        return products
+        if self._duplicates_merged > 0:
+            self._dirty = True  # у файлі ще лишилися дублікати
+            total = len(self._cache) + self._duplicates_merged
+            print(f"🧹 Видалено {self._duplicates_merged} дублікатів ({total} → {len(self._cache)})")
+
+        return self._cache
+
+    def get(self, product: Product) -> Optional[Product]:
+        """Шукає збережений продукт за первинним ключем."""
+        self._load_cache()
+        return self._index.get(product.key)
+
+    def find_by_sku(self, sku: str) -> List[Product]:
+        """Усі збережені продукти з заданим SKU."""
+        self._load_cache()
+        return list(self._by_sku.get(sku, []))
+
+    def find_by_uid(self, uid: str) -> Optional[Product]:
+        """Збережений продукт із заданим uid (Shopify product id)."""
+        self._load_cache()
+        return self._by_uid.get(uid)
+
+    def _find_renamed(self, product: Product) -> Optional[Product]:
+        """
+        Запис того самого продукту під іншим ключем: за uid, а серед записів
+        без uid (збережених до того, як uid почали зберігати) - єдиний з тим
+        самим SKU і тією самою назвою чи сторінкою.
+        """
+        existing = self.find_by_uid(product.uid) if product.uid else None
+        if existing is not None or not product.SKU:
+            return existing
+        candidates = [stored for stored in self.find_by_sku(product.SKU)
+                      if not stored.uid and (stored.page_name == product.page_name
+                                             or stored.car_name == product.car_name)]
+        return candidates[0] if len(candidates) == 1 else None
 
     def update_or_add(self, new_product: Product) -> None:
-        """Оновлює існуючий продукт або додає новий."""
+        """Оновлює існуючий продукт (зокрема перейменований) або додає новий."""
         if new_product.current_qty is None:
             return
 
-        existing_products = self._load_cache()
-        found = False
-
-        for existing in existing_products:
-            if existing.matches(new_product):
-                old_qty = existing.current_qty
-                old_max = existing.max_qty
+        existing = self.get(new_product)
+        renamed = None
+        if existing is None:
+            existing = renamed = self._find_renamed(new_product)
 
-                # Оновлюємо дані
-                existing.current_qty = new_product.current_qty
-                existing.max_qty = new_product.max_qty
-
-                # Оновлюємо тільки якщо порожні
-                if not existing.image_url:
-                    existing.image_url = new_product.image_url
-                if not existing.price:
-                    existing.price = new_product.price
-
-                # Логуємо тільки реальні зміни
-                if old_qty != new_product.current_qty or old_max != new_product.max_qty:
-                    print(
-                        f"📝 Оновлено {new_product.car_name[:40]}: qty {old_qty}→{new_product.current_qty}, max {old_max}→{new_product.max_qty}")
-
-                found = True
-                break
+        if existing is None:
+            log_item(f"➕ Новий: {new_product.car_name[:40]}")
+            self._insert(new_product)
+            self._mark_changed(new_product, 'added')
+            self._add_events(new_product, None)
+            return
 
-        if not found:
-            print(f"➕ Новий: {new_product.car_name[:40]}")
-            existing_products.append(new_product)
+        before = existing.csv_row()
+        old_qty = existing.current_qty
+        old_max = existing.max_qty
+        old_state = {'current_qty': old_qty, 'max_qty': old_max, 'price': existing.price}
+        if renamed is not None:
+            log_item(f"🔀 Перейменовано: {existing.car_name[:40]} → {new_product.car_name[:40]}")
+            self._rekey(existing, new_product)
+
+        # Оновлюємо дані
+        existing.current_qty = new_product.current_qty
+        existing.max_qty = new_product.max_qty
+
+        # Зображення - тільки якщо порожнє; ціну оновлюємо, якщо прийшла нова
+        if not existing.image_url:
+            existing.image_url = new_product.image_url
+        if new_product.price:
+            existing.price = new_product.price
+        if new_product.uid and existing.uid != new_product.uid:
+            existing.uid = new_product.uid
+            self._index_uid(existing)
+
+        if existing.csv_row() != before:
+            self._mark_changed(existing, 'updated')
+            self._add_events(existing, old_state)
+
+        # Логуємо тільки реальні зміни
+        if old_qty != new_product.current_qty or old_max != new_product.max_qty:
+            log_item(
+                f"📝 Оновлено {new_product.car_name[:40]}: qty {old_qty}→{new_product.current_qty}, max {old_max}→{new_product.max_qty}")
+
+    def _add_events(self, product: Product, old_state: Optional[Dict]) -> None:
+        new_state = {'current_qty': product.current_qty, 'max_qty': product.max_qty, 'price': product.price}
+        for event in stock_events(old_state, new_state):
+            self._events.append({'uid': product.uid, 'sku': product.SKU, 'name': product.car_name,
+                                 'page_name': product.page_name, **event})
+
+    def drain_events(self) -> List[Dict]:
+        """Забирає накопичені події (кожна віддається один раз)."""
+        events, self._events = self._events, []
+        return events
+
+    def attach_index(self, index: ProductIndex) -> None:
+        """Наповнює index поточними продуктами; далі кожна зміна оновлює його на місці."""
+        index.load(p.to_csv_dict() for p in self._load_cache())
+        self._query_index = index
+
+    def start_run(self) -> None:
+        """Починає новий запуск: дельта далі рахується з цього моменту."""
+        self._run_changes = {}
+
+    def _mark_changed(self, product: Product, change: str) -> None:
+        self._dirty = True
+        # Доданий за цей запуск продукт лишається 'added' навіть після оновлень
+        self._run_changes.setdefault(product.key, change)
+        if self._query_index is not None:
+            self._query_index.upsert(product.to_csv_dict())
 
     def save(self) -> None:
-        """Зберігає всі дані в CSV файл."""
+        """Зберігає всі дані в CSV файл (лише якщо щось змінилося)."""
         if self._cache is None:
             return
+        if not self._dirty:
+            print(f"💾 Без змін, {self.csv_file} не перезаписуємо")
+            return
 
         try:
-            with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES)
-                writer.writeheader()
-                writer.writerows([p.to_csv_dict() for p in self._cache])
+            with atomic_write(self.csv_file) as f:
+                writer = csv.writer(f)
+                writer.writerow(CSV_FIELDNAMES)
+                writer.writerows(p.csv_row() for p in self._cache)
+            self._dirty = False
             print(f"💾 Збережено {len(self._cache)} записів у {self.csv_file}")
         except IOError as e:
             print(f"❌ Помилка запису в CSV: {e}")
 
+    def write_delta(self, delta_file: str = DELTA_FILE) -> None:
+        """Записує продукти, додані або змінені за цей запуск."""
+        try:
+            with atomic_write(delta_file) as f:
+                writer = csv.writer(f)
+                writer.writerow(DELTA_FIELDNAMES)
+                writer.writerows((change, *self._index[key].csv_row()) for key, change in self._run_changes.items())
+            print(f"🧾 Змін за запуск: {len(self._run_changes)} (записано в {delta_file})")
+        except IOError as e:
+            print(f"❌ Помилка запису дельти: {e}")
 
-def main():
-    """Основна функція обробки всіх колекцій."""
-    print("🚀 Початок обробки колекцій Mattel\n")
 
-    token_manager = TokenManager()
-    csv_manager = CSVManager()
+class RefreshScheduler:
+    """
+    Планувальник оновлень: часто перевіряє продукти, що швидко розкуповуються,
+    і рідко - ті, де залишок не змінюється.
 
-    # Очищаємо дублікати перед початком
-    csv_manager.remove_duplicates()
-    csv_manager.save()
+    Для кожного uid зберігається оцінка швидкості зміни current_qty (одиниць
+    на годину, експоненційне згладжування) та час наступної перевірки.
+    Стан зберігається в SCHEDULE_FILE між запусками.
+    """
 
-    for collection in COLLECTIONS:
-        print(f"\n{'=' * 60}")
-        print(f"📦 Колекція: {collection}")
-        print('=' * 60)
+    def __init__(self, state_file: str = SCHEDULE_FILE, min_interval: float = REFRESH_MIN_INTERVAL):
+        self.state_file = state_file
+        self.min_interval = min_interval
+        self.slack = min(REFRESH_SLACK, min_interval / 4)
+        self._state: Dict[str, Dict] = {}
+        self._load()
 
+    def _load(self) -> None:
+        if not os.path.exists(self.state_file):
+            return
         try:
-            # Отримання даних з API
-            results = fetch_data_from_api(collection)
-            if not results:
-                print("⚠️ Немає результатів, пропускаємо колекцію")
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                self._state = json.load(f)
+        except (IOError, json.JSONDecodeError) as e:
+            print(f"⚠️ Помилка читання стану планувальника: {e}")
+            self._state = {}
+
+    def save(self) -> None:
+        """Зберігає стан (атомарно, щоб не лишити обрізаний JSON)."""
+        try:
+            with atomic_write(self.state_file) as f:
+                json.dump(self._state, f, ensure_ascii=False, sort_keys=True, indent=0)
+        except IOError as e:
+            print(f"❌ Помилка запису стану планувальника: {e}")
+
+    def _interval(self, rate: Optional[float], current_qty: int) -> float:
+        """Інтервал до наступної перевірки за оцінкою швидкості."""
+        if rate is None:
+            return self.min_interval  # новий продукт - ще нічого не знаємо
+        if rate <= 0:
+            return REFRESH_MAX_INTERVAL
+        interval = REFRESH_TARGET_DELTA / rate * 3600
+        if current_qty > 0:
+            # Не проспати розпродаж: залишок не повинен закінчитися між перевірками
+            interval = min(interval, current_qty / rate * 3600)
+        return max(self.min_interval, min(REFRESH_MAX_INTERVAL, interval))
+
+    def select_due(self, products: List[Product], now: Optional[float] = None,
+                   budget: Optional[int] = REFRESH_BUDGET) -> List[Product]:
+        """
+        Повертає продукти, які пора перевірити, у порядку пріоритету:
+        спочатку нові, потім найшвидші, не більше budget штук.
+        """
+        now = time.time() if now is None else now
+        new, due = [], []
+
+        for product in products:
+            if not self.is_due(product, now):
                 continue
+            if product.uid in self._state:
+                due.append(product)
+            else:
+                new.append(product)
+
+        due.sort(key=lambda p: (-(self._state[p.uid].get('rate') or 0),
+                                self._state[p.uid].get('next_due', 0)))
+        selected = new + due
+        if budget is not None:
+            selected = selected[:budget]
+
+        skipped = len(products) - len(selected)
+        print(f"🗓️ До перевірки: {len(selected)} продуктів ({len(new)} нових), відкладено {skipped}")
+        return selected
+
+    def is_due(self, product: Product, now: Optional[float] = None) -> bool:
+        """Чи пора перевіряти продукт (нові продукти - завжди)."""
+        entry = self._state.get(product.uid) if product.uid else None
+        if entry is None:
+            return True
+        now = time.time() if now is None else now
+        return entry.get('next_due', 0) <= now + self.slack
+
+    def iter_due(self, products: Iterable[Product], now: Optional[float] = None,
+                 budget: Optional[int] = REFRESH_BUDGET) -> Iterator[Product]:
+        """
+        Потоковий варіант select_due. Без бюджету продукти пропускаються одразу
+        по мірі надходження; з бюджетом для пріоритетів потрібен весь каталог,
+        тож спершу він збирається повністю.
+        """
+        if budget is not None:
+            yield from self.select_due(list(products), now, budget)
+            return
+
+        selected = skipped = 0
+        for product in products:
+            if self.is_due(product, now):
+                selected += 1
+                yield product
+            else:
+                skipped += 1
+        print(f"🗓️ Перевірено {selected} продуктів, відкладено {skipped}")
+
+    def record(self, product: Product, now: Optional[float] = None) -> None:
+        """Враховує свіжий залишок продукту та планує наступну перевірку."""
+        if not product.uid:
+            return
+        now = time.time() if now is None else now
+        entry = self._state.get(product.uid)
+        rate = None
+
+        if entry is not None:
+            hours = max((now - entry['checked_at']) / 3600, 1 / 60)
+            observed = abs(product.current_qty - entry['qty']) / hours
+            previous = entry.get('rate')
+            rate = observed if previous is None else (
+                REFRESH_RATE_SMOOTHING * observed + (1 - REFRESH_RATE_SMOOTHING) * previous)
+
+        self._state[product.uid] = {
+            'checked_at': now,
+            'qty': product.current_qty,
+            'rate': rate,
+            'next_due': now + self._interval(rate, product.current_qty),
+        }
+
 
-            # Обробка результатів
-            products = process_api_results(results)
-            if not products:
-                print("⚠️ Немає продуктів після фільтрації")
+class RunManifest:
+    """
+    Маніфест циклу оновлення: які uid уже оновлені та збережені, а які
+    не вдалося оновити (stale, з причиною).
+
+    Якщо попередній запуск не завершився (збій, 500-помилки, скасування),
+    наступний продовжує той самий цикл і пропускає вже оновлені продукти.
+    Маніфест записується після CSV, тож uid не вважається оновленим, поки
+    його дані не збережені.
+    """
+
+    def __init__(self, manifest_file: str = RUN_MANIFEST_FILE, now: Optional[float] = None):
+        self.manifest_file = manifest_file
+        self._lock = threading.Lock()
+        self.done: set = set()
+        self.stale: Dict[str, str] = {}
+        self.resumed = False
+        self._start(time.time() if now is None else now)
+
+    def _start(self, now: float) -> None:
+        previous = None
+        if os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                    previous = json.load(f)
+            except (IOError, json.JSONDecodeError) as e:
+                print(f"⚠️ Помилка читання маніфесту запуску: {e}")
+
+        if (previous and previous.get('status') != 'complete'
+                and now - previous.get('started_at', 0) <= RUN_RESUME_MAX_AGE):
+            self.started_at = previous['started_at']
+            self.done = set(previous.get('done', []))
+            self.stale = dict(previous.get('stale', {}))
+            self.resumed = True
+            print(f"⏯️ Продовжуємо перерваний цикл: уже оновлено {len(self.done)}, "
+                  f"повторимо {len(self.stale)} невдалих")
+        else:
+            self.started_at = now
+        self.status = 'running'
+
+    def iter_pending(self, products: Iterable[Product],
+                     is_due: Optional[Callable[[Product], bool]] = None) -> Iterator[Product]:
+        """
+        Пропускає продукти, уже оновлені в цьому циклі. is_due - планувальник:
+        оновлений продукт, якому знову настав час перевірки, не пропускається.
+        """
+        skipped = 0
+        for product in products:
+            if product.uid and product.uid in self.done and not (is_due and is_due(product)):
+                skipped += 1
                 continue
+            yield product
+        if skipped:
+            print(f"⏯️ Пропущено {skipped} продуктів, оновлених до перерви")
+
+    def mark_done(self, product: Product) -> None:
+        with self._lock:
+            self.done.add(product.uid)
+            self.stale.pop(product.uid, None)
+
+    def mark_stale(self, product: Product, reason: str) -> None:
+        with self._lock:
+            if product.uid and product.uid not in self.done:
+                self.stale[product.uid] = reason
+
+    def finish(self, success: bool) -> None:
+        """Цикл завершено; якщо були збої, наступний запуск його продовжить."""
+        with self._lock:
+            self.status = 'complete' if success and not self.stale else 'incomplete'
+        self.save()
 
-            # Оновлення кількості
-            products, success = update_products_qty(products, token_manager)
+    def save(self) -> None:
+        with self._lock:
+            state = {
+                'started_at': self.started_at,
+                'updated_at': time.time(),
+                'status': self.status,
+                'done': sorted(self.done),
+                'stale': dict(sorted(self.stale.items())),
+            }
+        try:
+            with atomic_write(self.manifest_file) as f:
+                json.dump(state, f, ensure_ascii=False, indent=0)
+        except IOError as e:
+            print(f"❌ Помилка запису маніфесту запуску: {e}")
 
-            if not success:
-                print("⚠️ Пропускаємо оновлення CSV через проблеми з API (500 або інші).")
-                continue  # переходимо до наступної колекції
 
-            # Якщо все ок — зберігаємо зміни
-            for product in products:
-                csv_manager.update_or_add(product)
+def run_collections(token_manager: TokenManager, csv_manager: CSVManager,
+                    scheduler: RefreshScheduler, history: HistoryStore,
+                    manifest: Optional[RunManifest] = None, collections: List[str] = COLLECTIONS,
+                    cancel: Optional[threading.Event] = None,
+                    flush_interval: Optional[float] = None,
+                    catalog_cache: Optional[CatalogCache] = None,
+                    feed: Optional[ChangeFeed] = None, processes: int = 1) -> bool:
+    """
+    Оновлює всі колекції одним потоком: пошук → фільтр → планувальник →
+    інвентар → збереження. Кожен продукт потрапляє у сховище одразу після
+    отримання залишку, а файли зберігаються кожні PIPELINE_FLUSH_EVERY продуктів
+    (і не рідше ніж раз на flush_interval секунд), тож збій наприкінці не губить
+    уже отримані дані.
+
+    З маніфестом уже оновлені в цьому циклі продукти пропускаються, а продукти,
+    які не вдалося оновити, позначаються як stale (їхні старі дані лишаються).
+    processes > 1 - інвентар запитують кілька процесів (update_products_qty_sharded).
+    Помилка злиття чи запису одного продукту не зупиняє решту: продукт
+    позначається як stale. Помилки окремих колекцій ізолює stream_catalog.
+    Повертає True, якщо оновлено все, що планувалося.
+    """
+    # Дублікати зливаються вже при завантаженні CSV
+    csv_manager.remove_duplicates()
 
-            csv_manager.save()
-            print(f"✅ Колекція оброблена")
+    store_lock = threading.Lock()
+    pending: List[Product] = []
+    stored = 0
+    failed = False  # хоч один продукт не вдалося злити чи зберегти
+    last_flush = time.monotonic()
 
+    def flush() -> None:
+        nonlocal last_flush, failed
+        last_flush = time.monotonic()
+        try:
+            with get_metrics().stage('save'):
+                # Стрічка пишеться до CSV: після збою події можуть повторитися, але не загубитися
+                if feed is not None:
+                    get_metrics().inc('feed_events', feed.append(csv_manager.drain_events()))
+                csv_manager.save()
+                scheduler.save()
+                history.record(pending)
+                if manifest is not None:
+                    for product in pending:
+                        manifest.mark_done(product)
         except Exception as e:
-            print(f"❌ Помилка: {e}")
-            continue
+            # Продукти не позначаються оновленими - наступний запуск їх повторить
+            print(f"❌ Помилка збереження {len(pending)} продуктів: {e}")
+            failed = True
+            for product in pending:
+                mark_stale(product, 'save_error')
+        if manifest is not None:
+            manifest.save()
+        pending.clear()
+
+    def store(product: Product) -> None:
+        nonlocal stored, failed
+        with store_lock:
+            try:
+                with get_metrics().stage('merge'):
+                    csv_manager.update_or_add(product)
+                    scheduler.record(product, product.checked_at)
+            except Exception as e:
+                print(f"❌ Помилка злиття {product.car_name[:40]}: {e}")
+                failed = True
+                mark_stale(product, 'merge_error')
+                return
+            pending.append(product)
+            stored += 1
+            get_metrics().inc('products_updated')
+            if len(pending) >= PIPELINE_FLUSH_EVERY or (
+                    flush_interval is not None and time.monotonic() - last_flush >= flush_interval):
+                flush()
+
+    def mark_stale(product: Product, reason: str) -> None:
+        get_metrics().inc('products_stale')
+        if manifest is not None:
+            manifest.mark_stale(product, reason)
+
+    # Каталог читається потоково; планувальник пропускає лише ті, яким настав час
+    catalog = stream_catalog(collections, cache=catalog_cache)
+    products = manifest.iter_pending(catalog, scheduler.is_due) if manifest is not None else catalog
+    try:
+        with get_metrics().stage('inventory'):
+            if processes > 1:
+                _, success = update_products_qty_sharded(scheduler.iter_due(products), token_manager, processes,
+                                                         on_updated=store, on_failed=mark_stale, cancel=cancel)
+            else:
+                _, success = update_products_qty(scheduler.iter_due(products), token_manager,
+                                                 on_updated=store, on_failed=mark_stale, cancel=cancel)
+    finally:
+        catalog.close()
+        with store_lock:
+            flush()
+
+    if not success:
+        print("⚠️ Частину продуктів не оновлено через проблеми з API (500 або інші).")
+    print(f"✅ Оновлено {stored} продуктів")
+    return success and not failed
+
+
+@contextmanager
+def using_storefront(storefront: Storefront):
+    """Перемикає адреси API на вітрину на час блоку (незадані адреси лишаються як є)."""
+    global API_BASE_URL, INVENTORY_API_URL, CHECKOUT_URL
+    saved = API_BASE_URL, INVENTORY_API_URL, CHECKOUT_URL
+    API_BASE_URL = storefront.search_url or API_BASE_URL
+    INVENTORY_API_URL = storefront.inventory_url or INVENTORY_API_URL
+    CHECKOUT_URL = storefront.checkout_url or CHECKOUT_URL
+    if storefront.inventory_url:
+        get_http_client().set_default_headers(INVENTORY_API_URL, INVENTORY_HEADERS)
+    try:
+        yield
+    finally:
+        API_BASE_URL, INVENTORY_API_URL, CHECKOUT_URL = saved
+
+
+def storefront_token_manager(storefront: Storefront, **kwargs) -> TokenManager:
+    """TokenManager вітрини (викликати всередині using_storefront)."""
+    if _replayer is not None:
+        return TokenManager(None, **kwargs)  # фальшивий токен не повинен потрапити в кеш
+    return TokenManager(storefront.token_cache_file or TOKEN_CACHE_FILE, **kwargs)
+
+
+def write_run_report(report_file: str = RUN_REPORT_FILE, prometheus_file: str = PROMETHEUS_FILE) -> None:
+    """Записує метрики запуску: JSON-звіт і textfile для Prometheus."""
+    metrics = get_metrics()
+    try:
+        with atomic_write(report_file) as f:
+            json.dump(metrics.report(), f, ensure_ascii=False, indent=1)
+        with atomic_write(prometheus_file) as f:
+            f.write(metrics.prometheus_text())
+    except IOError as e:
+        print(f"❌ Помилка запису звіту запуску: {e}")
+        return
+
+    print(f"📈 Звіт запуску: {report_file}, {prometheus_file} "
+          f"(401: {metrics.requests_with_status(401)}, 500: {metrics.requests_with_status(500)}, "
+          f"повторів: {int(sum(c['value'] for c in metrics.report()['counters'] if c['name'] == 'retries'))})")
+
+
+def start_query_service(csv_manager: CSVManager, port: int = QUERY_PORT, host: str = QUERY_HOST) -> QueryServer:
+    """Запускає HTTP-сервіс запитів (query.py) над продуктами csv_manager у фоновому потоці."""
+    from publish import get_category  # publish імпортує api_parser, тому не на рівні модуля
+    index = ProductIndex(categorize=get_category)
+    csv_manager.attach_index(index)
+    server = QueryServer(index, host, port)
+    server.start()
+    return server
+
+
+def serve(port: int = QUERY_PORT) -> None:
+    """Лише сервіс запитів над поточним CSV, без оновлень (до SIGTERM/SIGINT)."""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    server = start_query_service(CSVManager(), port)
+    try:
+        stop.wait()
+    finally:
+        server.close()
+
+
+def run_storefront(name: str, collections: List[str], csv_manager: CSVManager,
+                   scheduler: RefreshScheduler, history: HistoryStore, manifest: RunManifest,
+                   catalog_cache: CatalogCache, feed: ChangeFeed, processes: int = 1) -> bool:
+    """Оновлює колекції однієї вітрини. Помилка вітрини не зупиняє інші: False і далі."""
+    token_manager = None
+    with using_storefront(REGISTRY.storefronts[name]):
+        try:
+            token_manager = storefront_token_manager(REGISTRY.storefronts[name])
+            if TOKEN_BACKGROUND_REFRESH:
+                token_manager.start_background_refresh()
+            return run_collections(token_manager, csv_manager, scheduler, history, manifest,
+                                   collections=collections, catalog_cache=catalog_cache,
+                                   feed=feed, processes=processes)
+        except Exception as e:
+            print(f"❌ Помилка вітрини '{name}': {e}")
+            return False
+        finally:
+            if token_manager is not None:
+                token_manager.close()
+
+
+def main(quiet: bool = False, feed_stdout: bool = False, processes: int = PROCESSES):
+    """Основна функція обробки всіх колекцій (вітрини реєстру - по черзі)."""
+    global QUIET
+    QUIET = quiet
+    reset_metrics()
+    print("🚀 Початок обробки колекцій Mattel\n")
+
+    csv_manager = CSVManager()
+    scheduler = RefreshScheduler()
+    history = HistoryStore()
+    manifest = RunManifest()
+    catalog_cache = CatalogCache()
+    feed = ChangeFeed(sinks=default_sinks(stdout=feed_stdout))
+    success = False  # стає True лише після проходу всіх вітрин (перерваний запуск - незавершений)
 
+    try:
+        success = all([run_storefront(name, collections, csv_manager, scheduler, history, manifest,
+                                      catalog_cache, feed, processes)
+                       for name, collections in REGISTRY.by_storefront().items()])
+    finally:
+        # Стан зберігається навіть після збою, щоб наступний запуск продовжив цикл
+        try:
+            catalog_cache.finish()
+            catalog_cache.save()
+            if manifest.stale:
+                print(f"🕸️ Застарілі дані лишаються для {len(manifest.stale)} продуктів; "
+                      f"наступний запуск повторить їх")
+            manifest.finish(success)
+            with get_metrics().stage('save'):
+                csv_manager.write_delta()
+                history.compact()
+        finally:
+            history.close()
+            write_run_report()
+
+    get_http_client().print_stats()
     print("\n🎉 Обробка завершена!")
 
 
+def watch(interval: float = WATCH_INTERVAL, intervals: Optional[Dict[str, float]] = None,
+          flush_interval: float = WATCH_FLUSH_INTERVAL, quiet: bool = False,
+          feed_stdout: bool = False, processes: int = PROCESSES,
+          serve_port: Optional[int] = None) -> None:
+    """
+    Режим спостереження: один процес оновлює колекції за власним розкладом.
+
+    CSV, історія, стан планувальника, пули з'єднань і браузер з токеном
+    живуть у пам'яті між оновленнями, тож кожне оновлення коштує лише запитів.
+    Кожна колекція оновлюється раз на свій інтервал (intervals, потім
+    інтервали з реєстру, інакше interval).
+    serve_port - також запустити сервіс запитів (індекси оновлюються з кожним злиттям).
+    SIGTERM/SIGINT завершують поточні пакети, зберігають дані і закривають процес.
+    """
+    global QUIET
+    QUIET = quiet
+    intervals = {**WATCH_INTERVALS, **REGISTRY.intervals(), **(intervals or {})}
+    schedule = {name: intervals.get(name, interval) for name in COLLECTIONS}
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        if stop.is_set():
+            raise KeyboardInterrupt
+        print(f"\n🛑 Отримано {signal.Signals(signum).name}, зберігаємо дані та завершуємо...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    plan = ', '.join(f"{name.split('|')[1]} кожні {int(seconds)}с" for name, seconds in schedule.items())
+    print(f"👀 Режим спостереження: {plan}")
+    csv_manager = CSVManager()
+    scheduler = RefreshScheduler(min_interval=min(schedule.values()))
+    history = HistoryStore()
+    catalog_cache = CatalogCache()
+    feed = ChangeFeed(sinks=default_sinks(stdout=feed_stdout))
+    token_managers: Dict[str, TokenManager] = {}  # вітрина → TokenManager (створюється при першому оновленні)
+    server = start_query_service(csv_manager, serve_port) if serve_port else None
+
+    next_run = {name: 0.0 for name in schedule}
+    last_compact = time.time()
+    try:
+        while not stop.is_set():
+            now = time.time()
+            due = [name for name, at in next_run.items() if at <= now]
+            if not due:
+                stop.wait(min(next_run.values()) - now)
+                continue
+
+            reset_metrics()
+            csv_manager.start_run()
+            catalog_cache.start_run()
+            print(f"\n⏰ {time.strftime('%H:%M:%S')} Оновлюємо: {', '.join(name.split('|')[1] for name in due)}")
+            for name in due:
+                next_run[name] = now + schedule[name]
+
+            for name, collections in REGISTRY.by_storefront().items():
+                collections = [collection for collection in collections if collection in due]
+                if not collections or stop.is_set():
+                    continue
+                storefront = REGISTRY.storefronts[name]
+                with using_storefront(storefront):
+                    try:
+                        if name not in token_managers:
+                            token_managers[name] = storefront_token_manager(storefront, keep_browser=True)
+                            token_managers[name].start_background_refresh()
+                        run_collections(token_managers[name], csv_manager, scheduler, history,
+                                        collections=collections, cancel=stop, flush_interval=flush_interval,
+                                        catalog_cache=catalog_cache, feed=feed, processes=processes)
+                    except Exception as e:
+                        # Демон не падає через одну вітрину: наступний цикл спробує знову
+                        print(f"❌ Помилка вітрини '{name}': {e}")
+            catalog_cache.finish()
+            catalog_cache.save()
+            with get_metrics().stage('save'):
+                csv_manager.write_delta()
+                if now - last_compact >= WATCH_COMPACT_INTERVAL:
+                    history.compact()
+                    last_compact = now
+            write_run_report()
+    finally:
+        if server is not None:
+            server.close()
+        for token_manager in token_managers.values():
+            token_manager.close()
+        history.close()
+        get_http_client().close()
+        print("👋 Режим спостереження зупинено")
+
+
+def _collection_interval(value: str) -> Tuple[str, float]:
+    name, _, seconds = value.rpartition('=')
+    matches = [collection for collection in COLLECTIONS if name in (collection, collection.split('|')[1])]
+    if not matches or not seconds:
+        raise argparse.ArgumentTypeError(f"очікується КОЛЕКЦІЯ=СЕКУНДИ з {COLLECTIONS}")
+    return matches[0], float(seconds)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Оновлення залишків Mattel Creations")
+    parser.add_argument('--quiet', action='store_true', help="без рядків для кожного продукту")
+    parser.add_argument('--watch', action='store_true',
+                        help="не завершуватися, а оновлювати колекції за розкладом (до SIGTERM)")
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL,
+                        help="секунд між оновленнями колекції в режимі --watch")
+    parser.add_argument('--collection-interval', type=_collection_interval, action='append', default=[],
+                        metavar='КОЛЕКЦІЯ=СЕКУНДИ', help="окремий інтервал для колекції (можна повторювати)")
+    parser.add_argument('--flush-interval', type=float, default=WATCH_FLUSH_INTERVAL,
+                        help="секунд між записами файлів під час оновлення в режимі --watch")
+    parser.add_argument('--processes', type=int, default=PROCESSES,
+                        help="процесів для запитів інвентарю (токен спільний через кеш)")
+    parser.add_argument('--feed-stdout', action='store_true',
+                        help="друкувати події стрічки змін у stdout (JSON на рядок; разом з --quiet)")
+    parser.add_argument('--record', nargs='?', const=TRAFFIC_FILE, metavar='ФАЙЛ',
+                        help=f"записати всі запити й відповіді API (за замовчуванням {TRAFFIC_FILE})")
+    parser.add_argument('--replay', nargs='?', const=TRAFFIC_FILE, metavar='ФАЙЛ',
+                        help="відтворити записаний трафік замість мережі та Playwright "
+                             "(файли результатів оновлюються як зазвичай)")
+    parser.add_argument('--replay-timing', choices=REPLAY_TIMINGS, default='fast',
+                        help="fast - відповідати одразу, original - з записаною затримкою")
+    parser.add_argument('--serve', nargs='?', type=int, const=QUERY_PORT, metavar='ПОРТ',
+                        help=f"сервіс запитів на {QUERY_HOST} (за замовчуванням порт {QUERY_PORT}); "
+                             "з --watch індекси оновлюються разом з даними, без нього - лише поточний CSV")
+    parser.add_argument('--delisted', type=float, metavar='ДНІВ',
+                        help="лише показати продукти, зняті з продажу за останні N днів")
+    args = parser.parse_args()
+    if args.record and args.replay:
+        parser.error("--record і --replay не можна поєднувати")
+    configure_traffic(args.record, args.replay, args.replay_timing)
+    try:
+        if args.delisted is not None:
+            for row in CatalogCache().delisted(since=time.time() - args.delisted * 86400):
+                moment = time.strftime('%Y-%m-%d %H:%M', time.gmtime(row['removed_at']))
+                print(f"{moment}  {row['SKU']:<10} {row['uid']:<16} {row['car_name'][:60]}")
+        elif args.watch:
+            watch(args.interval, dict(args.collection_interval), args.flush_interval, quiet=args.quiet,
+                  feed_stdout=args.feed_stdout, processes=args.processes, serve_port=args.serve)
+        elif args.serve:
+            serve(args.serve)
+        else:
+            main(quiet=args.quiet, feed_stdout=args.feed_stdout, processes=args.processes)
+    finally:
+        configure_traffic()
@@ -0,0 +1,313 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+import api_parser
+
+# Константи
+BENCH_SIZES = [400, 5000, 50000]
+BENCH_LATENCY_MS = 50
+BENCH_TOKEN_TTL = 300  # секунд, як у справжнього токена (~5 хв)
+BENCH_MAX_BATCH = 50  # більші пакети productIds сервер відхиляє
+OVERLAP_EVERY = 10  # кожен N-й продукт є ще й у mattel-creations
+
+
+class FakeMattelHandler(BaseHTTPRequestHandler):
+    """Імітує API_BASE_URL (пошук з пагінацією) та INVENTORY_API_URL."""
+
+    protocol_version = 'HTTP/1.1'
+    config: Dict = {}
+    state: Dict = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _send_json(self, status: int, payload, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, name: str) -> int:
+        with self.lock:
+            self.state[name] = self.state.get(name, 0) + 1
+            return self.state[name]
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/token':
+            self._count('tokens')
+            token = f"Bearer bench-{time.time():.6f}"
+            with self.lock:
+                self.state.setdefault('issued', {})[token] = time.time()
+            return self._send_json(200, {'token': token})
+
+        if url.path == '/stats':
+            with self.lock:
+                return self._send_json(200, {k: v for k, v in self.state.items()
+                                         if k not in ('issued', 'window', 'window_count')})
+
+        time.sleep(self.config['latency_ms'] / 1000)
+
+        if url.path == '/search':
+            self._count('search')
+            page = self._search_page(query)
+            etag = '"%08x"' % zlib.crc32(json.dumps(page).encode('utf-8'))
+            if self.headers.get('If-None-Match') == etag:
+                self._count('status_304')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            return self._send_json(200, page, {'ETag': etag})
+
+        if url.path == '/inventory':
+            return self._inventory(query)
+
+        self._send_json(404, {'error': 'not found'})
+
+    def _search_page(self, query: Dict) -> Dict:
+        collection = query['bgfilter.collection_handle'][0]
+        collections = self.config['collections']
+        position = collections.index(collection)
+        per_page = int(query.get('resultsPerPage', ['999'])[0])
+        page = int(query.get('page', ['1'])[0])
+
+        # Продукт i належить колекції i % len(collections); частина - ще й останній
+        uids = [i for i in range(self.config['catalog_size'])
+                if i % len(collections) == position
+                or (position == len(collections) - 1 and i % OVERLAP_EVERY == 0)]
+        total_pages = max(1, (len(uids) + per_page - 1) // per_page)
+        results = [
+            {
+                'uid': str(1000000 + i),
+                'name': f"Bench Car {i}" + (" RLC" if i % 9 == 0 else ""),
+                'sku': f"B{i:06d}",
+                'url': f"/products/bench-car-{i}",
+                'price': f"{20 + i % 30}",
+                'imageUrl': f"https://cdn.example/bench/{i}.jpg?v=1",
+                'tags_category': ['Vehicles'] if i % 7 else ['Accessories'],
+            }
+            for i in uids[(page - 1) * per_page:page * per_page]
+        ]
+        return {'pagination': {'totalPages': total_pages, 'currentPage': page}, 'results': results}
+
+    def _over_rate_limit(self) -> bool:
+        """Чи перевищено rate_limit запитів інвентарю за поточну секунду."""
+        limit = self.config['rate_limit']
+        if not limit:
+            return False
+        second = int(time.time())
+        with self.lock:
+            if self.state.get('window') != second:
+                self.state['window'], self.state['window_count'] = second, 0
+            self.state['window_count'] += 1
+            return self.state['window_count'] > limit
+
+    def _inventory(self, query: Dict) -> None:
+        count = self._count('inventory')
+        if self._over_rate_limit():
+            self._count('status_429')
+            return self._send_json(429, {'error': 'too many requests'}, {'Retry-After': '1'})
+        auth = self.headers.get('Authorization', '')
+        with self.lock:
+            issued_at = self.state.get('issued', {}).get(auth)
+        if issued_at is None or time.time() - issued_at > self.config['token_ttl']:
+            self._count('status_401')
+            return self._send_json(401, {'error': 'unauthorized'})
+
+        burst_every, burst_len = self.config['burst_every'], self.config['burst_len']
+        if burst_every and count % burst_every < burst_len:
+            self._count('status_500')
+            return self._send_json(500, {'error': 'internal'})
+
+        gids = query.get('productIds', [''])[0].split(',')
+        if len(gids) > self.config['max_batch']:
+            self._count('status_400')
+            return self._send_json(400, {'error': 'too many ids'})
+
+        items = []
+        for gid in gids:
+            uid = int(gid.rsplit('/', 1)[-1])
+            max_qty = 1000 + uid % 5000
+            variants = [{'variant_inventorystatus': 'Available', 'variant_qty': max_qty}]
+            items.append({
+                'id': gid,
+                'totalInventory': (uid * 7919 + int(time.time())) % max_qty,
+                'variantMeta': {'value': json.dumps([{'variant_inventory': variants}])},
+            })
+        self._send_json(200, items)
+
+
+def _serve(config: Dict, port_queue) -> None:
+    """Запускає фейковий сервер в окремому процесі (щоб не ділити GIL і пам'ять з парсером)."""
+    FakeMattelHandler.config = config
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeMattelHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_benchmark(catalog_size: int, latency_ms: float = BENCH_LATENCY_MS,
+                  token_ttl: float = BENCH_TOKEN_TTL, burst_every: int = 0, burst_len: int = 0,
+                  max_batch: int = BENCH_MAX_BATCH, rate_limit: int = 0, processes: int = 1,
+                  verbose: bool = False) -> Dict:
+    """
+    Проганяє api_parser.main() проти локального сервера.
+    Повертає продукти/с, p50/p99 затримки запитів за ендпоінтом та пік пам'яті
+    (з processes > 1 затримки та пам'ять - лише процесу-координатора).
+    """
+    collections = [name.split('|')[1] for name in api_parser.COLLECTIONS]
+    config = {'catalog_size': catalog_size, 'latency_ms': latency_ms, 'token_ttl': token_ttl,
+              'burst_every': burst_every, 'burst_len': burst_len, 'max_batch': max_batch,
+              'rate_limit': rate_limit,
+              'collections': collections}
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve, args=(config, port_queue), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+    latencies: Dict[str, List[float]] = {}
+    latencies_lock = threading.Lock()
+    original_get = api_parser.HttpClient.get
+
+    def timed_get(client, url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original_get(client, url, *args, **kwargs)
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with latencies_lock:
+                latencies.setdefault(urlparse(url).path, []).append(elapsed)
+
+    def fetch_stub_token(manager) -> Optional[str]:
+        return requests.get(f"{base_url}/token", timeout=5).json()['token']
+
+    patches = {
+        (api_parser, 'API_BASE_URL'): f"{base_url}/search",
+        (api_parser, 'INVENTORY_API_URL'): f"{base_url}/inventory",
+        (api_parser, '_http_client'): None,
+        (api_parser.HttpClient, 'get'): timed_get,
+        (api_parser.TokenManager, '_fetch_token_with_playwright'): fetch_stub_token,
+    }
+    originals = {key: getattr(*key) for key in patches}
+    workdir = tempfile.mkdtemp(prefix='hwmc-bench-')
+    cwd = os.getcwd()
+    output = io.StringIO()  # вивід парсера (приховується, якщо не verbose)
+
+    try:
+        for (target, name), value in patches.items():
+            setattr(target, name, value)
+        os.chdir(workdir)
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(output):
+            api_parser.main(processes=processes)
+        elapsed = time.perf_counter() - started
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        server_stats = requests.get(f"{base_url}/stats", timeout=5).json()
+        with open(os.path.join(workdir, 'output.csv'), encoding='utf-8') as f:
+            stored = sum(1 for _ in f) - 1
+    finally:
+        os.chdir(cwd)
+        for (target, name), value in originals.items():
+            setattr(target, name, value)
+        server.terminate()
+        server.join()
+
+    return {
+        'catalog_size': catalog_size,
+        'stored_products': stored,
+        'seconds': round(elapsed, 3),
+        'products_per_second': round(stored / elapsed, 1) if elapsed else 0.0,
+        'peak_memory_mb': round(peak_memory / 1024 / 1024, 1),
+        'server': server_stats,
+        'latency_ms': {
+            path: {'count': len(values),
+                   'p50': round(_percentile(values, 50), 1),
+                   'p99': round(_percentile(values, 99), 1)}
+            for path, values in latencies.items()
+        },
+        'workdir': workdir,
+    }
+
+
+def print_report(result: Dict) -> None:
+    print(f"\n📊 Каталог {result['catalog_size']}: збережено {result['stored_products']} продуктів "
+          f"за {result['seconds']}с ({result['products_per_second']} продуктів/с), "
+          f"пік пам'яті {result['peak_memory_mb']} МБ")
+    for path, stat in sorted(result['latency_ms'].items()):
+        print(f"   {path:<12} {stat['count']:>6} запитів  p50 {stat['p50']:>7} мс  p99 {stat['p99']:>7} мс")
+    server = result['server']
+    print(f"   сервер: токенів {server.get('tokens', 0)}, 401: {server.get('status_401', 0)}, "
+          f"500: {server.get('status_500', 0)}, 429: {server.get('status_429', 0)}, "
+          f"400: {server.get('status_400', 0)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк api_parser проти локального сервера")
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCH_SIZES,
+                        help="розміри каталогу (кількість продуктів)")
+    parser.add_argument('--latency-ms', type=float, default=BENCH_LATENCY_MS)
+    parser.add_argument('--token-ttl', type=float, default=BENCH_TOKEN_TTL,
+                        help="через скільки секунд сервер відповідає 401")
+    parser.add_argument('--burst-every', type=int, default=0,
+                        help="кожні N запитів інвентарю - серія 500-помилок (0 - вимкнено)")
+    parser.add_argument('--burst-len', type=int, default=2)
+    parser.add_argument('--max-batch', type=int, default=BENCH_MAX_BATCH)
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help="запитів інвентарю за секунду, далі 429 з Retry-After (0 - вимкнено)")
+    parser.add_argument('--processes', type=int, default=1, help="процесів для запитів інвентарю")
+    parser.add_argument('--json', help="записати результати у JSON-файл")
+    parser.add_argument('--verbose', action='store_true', help="не приховувати вивід парсера")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        result = run_benchmark(size, latency_ms=args.latency_ms, token_ttl=args.token_ttl,
+                               burst_every=args.burst_every, burst_len=args.burst_len,
+                               max_batch=args.max_batch, rate_limit=args.rate_limit,
+                               processes=args.processes,
+                               verbose=args.verbose)
+        print_report(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
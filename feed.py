@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import requests
+
+try:
+    import fcntl  # блокування стрічки між процесами (немає на Windows)
+except ImportError:
+    fcntl = None
+
+# Константи
+FEED_FILE = 'changes.jsonl'
+FEED_WEBHOOK_URL = os.environ.get('HWMC_FEED_WEBHOOK')  # None - не надсилати
+FEED_WEBHOOK_TIMEOUT = 5  # секунд
+FEED_READ_LIMIT = 1000  # подій за одне читання за замовчуванням
+
+EVENT_TYPES = ('listed', 'restock', 'sold_out', 'max_qty', 'price')
+
+
+def stock_events(old: Optional[Dict], new: Dict) -> List[Dict]:
+    """
+    Події для одного продукту: old і new - словники з current_qty, max_qty, price
+    (old=None для нового продукту). Повертає події без seq і ts.
+    """
+    if old is None:
+        return [{'type': 'listed', 'old': None,
+                 'new': {key: new[key] for key in ('current_qty', 'max_qty', 'price')}}]
+
+    events = []
+    if new['current_qty'] > old['current_qty']:
+        events.append({'type': 'restock', 'old': old['current_qty'], 'new': new['current_qty']})
+    elif new['current_qty'] <= 0 < old['current_qty']:
+        events.append({'type': 'sold_out', 'old': old['current_qty'], 'new': new['current_qty']})
+    if new['max_qty'] != old['max_qty']:
+        events.append({'type': 'max_qty', 'old': old['max_qty'], 'new': new['max_qty']})
+    if new['price'] and old['price'] and new['price'] != old['price']:
+        events.append({'type': 'price', 'old': old['price'], 'new': new['price']})
+    return events
+
+
+def format_cursor(seq: int, offset: int) -> str:
+    return f"{seq}:{offset}"
+
+
+def parse_cursor(cursor) -> Tuple[int, Optional[int]]:
+    """Курсор - 'seq:offset' (з попереднього читання) або просто seq."""
+    if cursor in (None, ''):
+        return 0, 0
+    seq, _, offset = str(cursor).partition(':')
+    return int(seq), int(offset) if offset else None
+
+
+class StdoutSink:
+    """Друкує кожну подію одним рядком JSON (для конвеєрів і ботів)."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def send(self, events: List[Dict]) -> None:
+        for event in events:
+            self.stream.write(json.dumps(event, ensure_ascii=False) + '\n')
+        self.stream.flush()
+
+
+class WebhookSink:
+    """POST пакета подій на локальний webhook. Помилки не зупиняють запуск: стрічка лишається джерелом правди."""
+
+    def __init__(self, url: str, timeout: float = FEED_WEBHOOK_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, events: List[Dict]) -> None:
+        try:
+            response = requests.post(self.url, json={'events': events}, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"⚠️ Webhook стрічки змін недоступний ({self.url}): {e}")
+
+
+class ChangeFeed:
+    """
+    Стрічка змін: append-only JSONL, кожна подія має зростаючий seq.
+
+    Споживач читає з курсора (read), отримує події після нього і новий
+    курсор. Курсор містить зміщення у файлі, тож читання не залежить
+    від довжини стрічки.
+    """
+
+    def __init__(self, feed_file: str = FEED_FILE, sinks: Optional[List] = None):
+        self.feed_file = feed_file
+        self.sinks = sinks if sinks is not None else []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """Блокування між процесами на час дописування (див. TokenCache.locked)."""
+        if fcntl is None:
+            yield
+            return
+        with open(self.feed_file + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def last_seq(self) -> int:
+        """seq останньої події (0 для порожньої стрічки); читає лише кінець файлу."""
+        if not os.path.exists(self.feed_file):
+            return 0
+        with open(self.feed_file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            block = 4096
+            while True:
+                start = max(0, end - block)
+                f.seek(start)
+                lines = f.read(end - start).splitlines()
+                complete = [line for line in (lines if start == 0 else lines[1:]) if line.strip()]
+                if complete:
+                    return json.loads(complete[-1])['seq']
+                if start == 0:
+                    return 0
+                block *= 2
+
+    def append(self, events: Iterable[Dict]) -> int:
+        """Дописує події (присвоює seq і ts) і передає їх у sinks. Повертає кількість."""
+        events = list(events)
+        if not events:
+            return 0
+        now = time.time()
+        with self._lock, self._locked():
+            seq = self.last_seq()
+            for event in events:
+                seq += 1
+                event['seq'] = seq
+                event.setdefault('ts', now)
+            with open(self.feed_file, 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(event, ensure_ascii=False, sort_keys=True) + '\n'
+                                for event in events))
+                f.flush()
+                os.fsync(f.fileno())
+
+        for sink in self.sinks:
+            sink.send(events)
+        return len(events)
+
+    def read(self, cursor=None, limit: int = FEED_READ_LIMIT,
+             types: Optional[Iterable[str]] = None) -> Tuple[List[Dict], str]:
+        """
+        Події після курсора (не більше limit) і курсор для наступного читання.
+        types - лише події цих типів (курсор однаково просувається).
+        """
+        after_seq, offset = parse_cursor(cursor)
+        wanted = set(types) if types else None
+        if not os.path.exists(self.feed_file):
+            return [], format_cursor(after_seq, 0)
+
+        with open(self.feed_file, 'rb') as f:
+            if offset is not None:
+                # Перевіряємо, що курсор вказує на початок події після after_seq;
+                # інакше (стрічку перезаписано, курсор зіпсовано) шукаємо з початку
+                f.seek(offset)
+                first = f.readline()
+                try:
+                    valid = not first.strip() or json.loads(first)['seq'] == after_seq + 1
+                except (ValueError, KeyError):
+                    valid = False
+                offset = offset if valid else 0
+            f.seek(offset or 0)
+
+            events = []
+            position = f.tell()
+            last_seq = after_seq
+            while len(events) < limit:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break  # порожньо або подія ще дописується
+                event = json.loads(line)
+                position += len(line)
+                if event['seq'] <= after_seq:
+                    continue
+                last_seq = event['seq']
+                if wanted is None or event['type'] in wanted:
+                    events.append(event)
+        return events, format_cursor(last_seq, position)
+
+
+def default_sinks(stdout: bool = False) -> List:
+    sinks = []
+    if FEED_WEBHOOK_URL:
+        sinks.append(WebhookSink(FEED_WEBHOOK_URL))
+    if stdout:
+        sinks.append(StdoutSink())
+    return sinks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Читання стрічки змін залишків")
+    parser.add_argument('--feed', default=FEED_FILE)
+    parser.add_argument('--cursor', help="курсор з попереднього читання (або seq)")
+    parser.add_argument('--limit', type=int, default=FEED_READ_LIMIT)
+    parser.add_argument('--type', action='append', choices=EVENT_TYPES, help="лише події цього типу")
+    args = parser.parse_args()
+
+    events, cursor = ChangeFeed(args.feed).read(args.cursor, args.limit, args.type)
+    StdoutSink().send(events)
+    # Курсор - у stderr, щоб stdout лишався чистим JSONL
+    print(f"cursor={cursor}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import argparse
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Константи
+HISTORY_DB = 'history.sqlite'
+
+# Проріджування старих знімків: (старші за N секунд, один знімок на інтервал)
+DOWNSAMPLE_TIERS = [
+    (30 * 24 * 3600, 24 * 3600),  # старші за 30 днів - один на добу
+    (365 * 24 * 3600, 7 * 24 * 3600),  # старші за рік - один на тиждень
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    uid TEXT NOT NULL,
+    sku TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    current_qty INTEGER NOT NULL,
+    max_qty INTEGER NOT NULL,
+    price TEXT NOT NULL,
+    PRIMARY KEY (uid, ts)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_snapshots_ts ON snapshots (ts);
+CREATE INDEX IF NOT EXISTS idx_snapshots_sku_ts ON snapshots (sku, ts);
+"""
+
+# Продано за вікно: сума всіх зменшень current_qty між сусідніми знімками.
+# Базою кожного продукту є останній знімок до початку вікна (пошук за PRIMARY KEY),
+# тож запит читає лише вікно, а не всю історію.
+SOLD_SINCE_SQL = """
+WITH recent AS (
+    SELECT uid, ts, current_qty FROM snapshots WHERE ts > :start
+),
+base AS (
+    SELECT u.uid AS uid,
+           (SELECT s.ts FROM snapshots s
+            WHERE s.uid = u.uid AND s.ts <= :start
+            ORDER BY s.ts DESC LIMIT 1) AS ts
+    FROM (SELECT DISTINCT uid FROM recent) u
+),
+series AS (
+    SELECT uid, ts, current_qty FROM recent
+    UNION ALL
+    SELECT s.uid, s.ts, s.current_qty
+    FROM base b JOIN snapshots s ON s.uid = b.uid AND s.ts = b.ts
+),
+deltas AS (
+    SELECT uid, ts, current_qty,
+           LAG(current_qty) OVER (PARTITION BY uid ORDER BY ts) AS prev_qty,
+           ROW_NUMBER() OVER (PARTITION BY uid ORDER BY ts DESC) AS rn
+    FROM series
+)
+SELECT d.uid,
+       (SELECT sku FROM snapshots WHERE uid = d.uid ORDER BY ts DESC LIMIT 1) AS sku,
+       SUM(CASE WHEN d.prev_qty > d.current_qty THEN d.prev_qty - d.current_qty ELSE 0 END) AS sold,
+       MAX(CASE WHEN d.rn = 1 THEN d.current_qty END) AS current_qty
+FROM deltas d
+GROUP BY d.uid
+HAVING sold > 0
+ORDER BY sold DESC
+"""
+
+
+class HistoryStore:
+    """
+    Історія залишків: додає знімок (uid, SKU, час, current_qty, max_qty, price)
+    для кожного перевіреного продукту і ніколи не перезаписує минулі.
+
+    SQLite у режимі WAL: читачі (запити, details) не блокують запис.
+    Знімки одного продукту лежать поруч (PRIMARY KEY (uid, ts) WITHOUT ROWID),
+    тому історія продукту - це один діапазон індексу.
+    """
+
+    def __init__(self, db_file: str = HISTORY_DB):
+        self.db_file = db_file
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+
+    def record(self, products: Iterable, ts: Optional[float] = None) -> int:
+        """
+        Додає знімки продуктів (будь-які об'єкти з uid, SKU, current_qty, max_qty, price).
+        Час знімка - product.checked_at, якщо він є, інакше ts або поточний час.
+        Повертає кількість доданих знімків.
+        """
+        default_ts = time.time() if ts is None else ts
+        rows = [
+            (p.uid, p.SKU or '', int(getattr(p, 'checked_at', None) or default_ts),
+             int(p.current_qty), int(p.max_qty), str(p.price or ''))
+            for p in products if p.uid
+        ]
+        if not rows:
+            return 0
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO snapshots (uid, sku, ts, current_qty, max_qty, price) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def product_history(self, uid: Optional[str] = None, sku: Optional[str] = None,
+                        since: Optional[float] = None, until: Optional[float] = None) -> List[Dict]:
+        """Знімки продукту (за uid або SKU) у часовому вікні, від старих до нових."""
+        if not uid and not sku:
+            raise ValueError("Потрібен uid або sku")
+        column, value = ('uid', uid) if uid else ('sku', sku)
+        query = (f"SELECT uid, sku, ts, current_qty, max_qty, price FROM snapshots "
+                 f"WHERE {column} = ? AND ts >= ? AND ts <= ? ORDER BY ts")
+        params = (value, int(since or 0), int(until if until is not None else 2 ** 62))
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(query, params)]
+
+    def sold_since(self, hours: float, now: Optional[float] = None) -> List[Dict]:
+        """Продукти, що продавалися за останні hours годин, від найбільших продажів."""
+        now = time.time() if now is None else now
+        start = int(now - hours * 3600)
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(SOLD_SINCE_SQL, {'start': start})]
+
+    def compact(self, now: Optional[float] = None,
+                tiers: List[Tuple[int, int]] = DOWNSAMPLE_TIERS) -> int:
+        """
+        Проріджує старі знімки: у кожному інтервалі tier залишає останній знімок
+        продукту. Повертає кількість видалених знімків.
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        with self._lock, self._conn:
+            for age, bucket in tiers:
+                cutoff = int(now - age)
+                cursor = self._conn.execute(
+                    "DELETE FROM snapshots WHERE ts < :cutoff AND (uid, ts) NOT IN ("
+                    "  SELECT uid, MAX(ts) FROM snapshots WHERE ts < :cutoff "
+                    "  GROUP BY uid, ts / :bucket)",
+                    {'cutoff': cutoff, 'bucket': bucket})
+                removed += cursor.rowcount
+        if removed:
+            print(f"🗜️ Історія: проріджено {removed} старих знімків")
+        return removed
+
+    def close(self) -> None:
+        """Переносить WAL в основний файл (щоб у кеш Actions потрапив цілий файл без -wal) і закриває БД."""
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Запити до історії залишків")
+    parser.add_argument('--db', default=HISTORY_DB)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sold = commands.add_parser('sold', help="що продавалося за останні N годин")
+    sold.add_argument('--hours', type=float, default=24)
+    sold.add_argument('--limit', type=int, default=50)
+
+    product = commands.add_parser('product', help="історія продукту за uid або SKU")
+    product.add_argument('key', help="uid або SKU")
+    product.add_argument('--hours', type=float, default=24 * 7)
+
+    commands.add_parser('compact', help="проріджує старі знімки")
+
+    args = parser.parse_args()
+    store = HistoryStore(args.db)
+    try:
+        if args.command == 'sold':
+            for row in store.sold_since(args.hours)[:args.limit]:
+                print(f"{row['sku']:<10} {row['uid']:<16} продано {row['sold']:>6}, залишок {row['current_qty']}")
+        elif args.command == 'product':
+            since = time.time() - args.hours * 3600
+            rows = store.product_history(uid=args.key, since=since) or \
+                store.product_history(sku=args.key, since=since)
+            for row in rows:
+                moment = time.strftime('%Y-%m-%d %H:%M', time.gmtime(row['ts']))
+                print(f"{moment}  qty {row['current_qty']:>6}  max {row['max_qty']:>6}  ${row['price']}")
+        elif args.command == 'compact':
+            store.compact()
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
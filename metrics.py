@@ -0,0 +1,185 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+# Константи
+METRICS_PREFIX = 'hwmc'
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]  # секунд
+TOKEN_BUCKETS = [0.5, 1, 2, 5, 10, 20, 40, 80]  # секунд
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(values: Dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in values.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Histogram:
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_dict(self) -> Dict:
+        return {'count': self.count, 'sum': round(self.sum, 4), 'max': round(self.max, 4),
+                'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)}}
+
+
+class RunMetrics:
+    """
+    Метрики одного запуску: час етапів, гістограми затримок запитів
+    (за ендпоінтом і статусом), лічильники та тривалість оновлення токена.
+
+    Усі методи потокобезпечні. Наприкінці запуску report() дає JSON-звіт,
+    а prometheus_text() - textfile для node_exporter.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._stages: Dict[Tuple[str, Labels], Dict[str, float]] = {}
+        self._requests: Dict[Labels, _Histogram] = {}
+        self._token_refreshes: Dict[Labels, _Histogram] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+
+    @contextmanager
+    def stage(self, name: str, **labels):
+        """Вимірює етап; повторні входи в той самий етап підсумовуються."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            key = (name, _labels(labels))
+            with self._lock:
+                entry = self._stages.setdefault(key, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+                entry['count'] += 1
+                entry['seconds'] += elapsed
+                entry['max'] = max(entry['max'], elapsed)
+
+    def observe_request(self, endpoint: str, status: object, seconds: float) -> None:
+        key = _labels({'endpoint': endpoint, 'status': status})
+        with self._lock:
+            self._requests.setdefault(key, _Histogram(LATENCY_BUCKETS)).observe(seconds)
+
+    def observe_token_refresh(self, seconds: float, source: str, success: bool) -> None:
+        key = _labels({'source': source, 'success': str(success).lower()})
+        with self._lock:
+            self._token_refreshes.setdefault(key, _Histogram(TOKEN_BUCKETS)).observe(seconds)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get((name, _labels(labels)), 0)
+
+    def requests_with_status(self, status: object) -> int:
+        """Скільки запитів (усіх ендпоінтів) завершилися з цим статусом."""
+        with self._lock:
+            return sum(histogram.count for labels, histogram in self._requests.items()
+                       if dict(labels).get('status') == str(status))
+
+    def report(self) -> Dict:
+        """Звіт запуску для JSON."""
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'duration_seconds': round(time.time() - self.started_at, 3),
+                'stages': [
+                    {'stage': name, **dict(labels), 'count': entry['count'],
+                     'seconds': round(entry['seconds'], 4), 'max_seconds': round(entry['max'], 4)}
+                    for (name, labels), entry in sorted(self._stages.items())
+                ],
+                'requests': [
+                    {**dict(labels), **histogram.to_dict()}
+                    for labels, histogram in sorted(self._requests.items())
+                ],
+                'token_refreshes': [
+                    {**dict(labels), **histogram.to_dict()}
+                    for labels, histogram in sorted(self._token_refreshes.items())
+                ],
+                'counters': [
+                    {'name': name, **dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+            }
+
+    def prometheus_text(self) -> str:
+        """Метрики у текстовому форматі Prometheus (для textfile collector)."""
+        p = METRICS_PREFIX
+        lines = [
+            f"# HELP {p}_run_timestamp_seconds Час початку запуску.",
+            f"# TYPE {p}_run_timestamp_seconds gauge",
+            f"{p}_run_timestamp_seconds {self.started_at:.3f}",
+            f"# HELP {p}_run_duration_seconds Тривалість запуску.",
+            f"# TYPE {p}_run_duration_seconds gauge",
+            f"{p}_run_duration_seconds {time.time() - self.started_at:.3f}",
+        ]
+
+        with self._lock:
+            lines += [f"# HELP {p}_stage_seconds Сумарний час етапу (етапи можуть перекриватися).",
+                      f"# TYPE {p}_stage_seconds gauge"]
+            for (name, labels), entry in sorted(self._stages.items()):
+                stage_labels = _labels({'stage': name, **dict(labels)})
+                lines.append(f"{p}_stage_seconds{_format_labels(stage_labels)} {entry['seconds']:.4f}")
+            lines += [f"# TYPE {p}_stage_runs gauge"]
+            for (name, labels), entry in sorted(self._stages.items()):
+                stage_labels = _labels({'stage': name, **dict(labels)})
+                lines.append(f"{p}_stage_runs{_format_labels(stage_labels)} {entry['count']}")
+
+            for metric, histograms, help_text in (
+                    (f"{p}_request_duration_seconds", self._requests, "Затримка HTTP-запитів."),
+                    (f"{p}_token_refresh_seconds", self._token_refreshes, "Тривалість отримання токена.")):
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+                for labels, histogram in sorted(histograms.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{metric}_bucket{_format_labels(labels, ('le', str(bound)))} {count}")
+                    lines.append(f"{metric}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+                    lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.sum:.4f}")
+                    lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+
+            names = sorted({name for name, _ in self._counters})
+            for name in names:
+                lines.append(f"# TYPE {p}_{name}_total counter")
+                for (counter_name, labels), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append(f"{p}_{name}_total{_format_labels(labels)} {value:g}")
+
+        return '\n'.join(lines) + '\n'
+
+
+_metrics = RunMetrics()
+
+
+def get_metrics() -> RunMetrics:
+    """Метрики поточного запуску."""
+    return _metrics
+
+
+def reset_metrics() -> RunMetrics:
+    """Починає нові метрики (наприклад, для наступного запуску в тому ж процесі)."""
+    global _metrics
+    _metrics = RunMetrics()
+    return _metrics
@@ -0,0 +1,165 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from api_parser import CSVManager, Product, atomic_write
+
+try:
+    import brotli  # необов'язково: без нього публікуються лише .json і .json.gz
+except ImportError:
+    brotli = None
+
+# Константи
+PUBLISH_DIR = 'public'
+MANIFEST_FILE = 'manifest.json'
+HASH_LENGTH = 12
+
+# Порядок важливий: перша категорія, що підходить, виграє (як getCategory у details.html)
+CATEGORY_RULES = [
+    ('RLC', 'RLC'),
+    ('Elite 64', 'Elite 64'),
+    ('Premium', 'Premium'),
+    ('Matchbox', 'Matchbox'),
+]
+OTHER_CATEGORY = 'Other'
+
+SHARD_COLUMNS = ['car_name', 'SKU', 'page_name', 'max_qty', 'current_qty', 'image_url', 'price', 'category']
+SORT_COLUMNS = ['category', 'car_name', 'current_qty', 'max_qty', 'price']
+
+
+def get_category(car_name: str) -> str:
+    """Визначає категорію продукту за назвою."""
+    for marker, category in CATEGORY_RULES:
+        if marker in car_name:
+            return category
+    return OTHER_CATEGORY
+
+
+def category_slug(category: str) -> str:
+    return category.lower().replace(' ', '-')
+
+
+def _parse_price(price: str) -> Optional[float]:
+    try:
+        return float(price)
+    except (TypeError, ValueError):
+        return None
+
+
+def build_shard(products: List[Product]) -> Dict:
+    """
+    Будує шард: рядки з уже типізованими значеннями та, для кожного стовпця
+    сортування, масив індексів рядків у порядку зростання.
+    """
+    rows = [
+        [p.car_name, p.SKU, p.page_name, p.max_qty, p.current_qty, p.image_url,
+         _parse_price(p.price), get_category(p.car_name)]
+        for p in products
+    ]
+
+    sort_index = {}
+    for column in SORT_COLUMNS:
+        position = SHARD_COLUMNS.index(column)
+        if column in ('car_name', 'category'):
+            key = lambda i: rows[i][position].lower()
+        else:
+            # Продукти без ціни - в кінці
+            key = lambda i: (rows[i][position] is None, rows[i][position] or 0)
+        sort_index[column] = sorted(range(len(rows)), key=key)
+
+    return {'columns': SHARD_COLUMNS, 'rows': rows, 'sort': sort_index}
+
+
+def _write_variants(name: str, shard: Dict, publish_dir: str) -> Dict:
+    """Записує шард як name.<hash>.json (+ .gz, .br). Повертає запис для маніфесту."""
+    raw = json.dumps(shard, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    digest = hashlib.sha256(raw).hexdigest()[:HASH_LENGTH]
+    base = f"{name}.{digest}.json"
+
+    variants = {'json': (base, raw),
+                'gzip': (f"{base}.gz", gzip.compress(raw, compresslevel=9, mtime=0))}
+    if brotli is not None:
+        variants['br'] = (f"{base}.br", brotli.compress(raw))
+
+    entry = {'rows': len(shard['rows']), 'bytes': len(raw)}
+    for encoding, (filename, content) in variants.items():
+        path = os.path.join(publish_dir, filename)
+        # Ім'я містить хеш вмісту, а запис атомарний: файл потрібного розміру вже правильний.
+        # Перевірка розміру лікує обрізані файли, записані раніше без атомарного запису
+        if not os.path.exists(path) or os.path.getsize(path) != len(content):
+            with atomic_write(path, binary=True) as f:
+                f.write(content)
+        entry[encoding] = filename
+    return entry
+
+
+def _referenced(manifest: Optional[Dict]) -> set:
+    """Імена файлів шардів, на які посилається маніфест."""
+    if not manifest:
+        return set()
+    names = set()
+    for entry in [manifest.get('all', {}), *manifest.get('categories', {}).values()]:
+        names.update(entry[key] for key in ('json', 'gzip', 'br') if key in entry)
+    return names
+
+
+def _read_manifest(path: str) -> Optional[Dict]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def publish(csv_file: str = 'output.csv', publish_dir: str = PUBLISH_DIR) -> Dict:
+    """
+    Публікує дані для details.html: шард з усіма продуктами, шард на кожну
+    категорію і маніфест з іменами файлів.
+
+    Якщо жоден шард не змінився, попередній маніфест лишається як є (без
+    нового generated_at і без коміту). Шарди попереднього покоління
+    (manifest['previous']) не видаляються: raw.githubusercontent кешує
+    manifest.json кілька хвилин, і закешований маніфест мусить указувати на
+    наявні файли. Видаляються лише файли, на які не посилається ні новий,
+    ні попередній маніфест.
+    """
+    products = CSVManager(csv_file)._load_cache()
+    os.makedirs(publish_dir, exist_ok=True)
+    manifest_path = os.path.join(publish_dir, MANIFEST_FILE)
+    previous = _read_manifest(manifest_path)
+
+    by_category: Dict[str, List[Product]] = {}
+    for product in products:
+        by_category.setdefault(get_category(product.car_name), []).append(product)
+
+    manifest = {
+        'generated_at': int(time.time()),
+        'all': _write_variants('all', build_shard(products), publish_dir),
+        'categories': {
+            category: _write_variants(category_slug(category), build_shard(items), publish_dir)
+            for category, items in sorted(by_category.items())
+        },
+    }
+
+    if previous is not None and all(previous.get(key) == manifest[key] for key in ('all', 'categories')):
+        manifest = previous
+    else:
+        # Попереднє покоління потрібне, поки маніфест, що на нього вказує, ще в кешах
+        manifest['previous'] = sorted(_referenced(previous))
+        with atomic_write(manifest_path) as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+    referenced = {MANIFEST_FILE, *manifest.get('previous', [])} | _referenced(manifest)
+    for filename in os.listdir(publish_dir):
+        if filename not in referenced:
+            os.remove(os.path.join(publish_dir, filename))
+
+    print(f"📤 Опубліковано {len(products)} продуктів у {len(by_category)} категоріях → {publish_dir}/")
+    return manifest
+
+
+if __name__ == "__main__":
+    publish()
@@ -0,0 +1,334 @@
+import base64
+import hashlib
+import json
+import threading
+from bisect import bisect_left, bisect_right, insort
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Константи
+QUERY_HOST = '127.0.0.1'
+QUERY_PORT = 8765
+QUERY_PAGE_SIZE = 50
+QUERY_MAX_PAGE_SIZE = 500
+
+NUMERIC_FIELDS = ('current_qty', 'max_qty', 'price')
+SORT_FIELDS = ('car_name',) + NUMERIC_FIELDS
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _price(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _sort_key(field: str, row: Dict) -> Tuple:
+    """Ключ сортування; продукти без ціни - в кінці (як у publish.build_shard)."""
+    if field == 'car_name':
+        return (row['car_name'].lower(),)
+    value = row[field]
+    return (value is None, value if value is not None else 0)
+
+
+def encode_cursor(key: Tuple, row_id: int) -> str:
+    raw = json.dumps([list(key), row_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[Tuple, int]:
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    key, row_id = json.loads(raw)
+    return tuple(key), int(row_id)
+
+
+class ProductIndex:
+    """
+    Продукти в пам'яті з індексами для запитів:
+    - SKU і категорія → множини рядків;
+    - триграми назви → множини рядків (пошук підрядка без перебору);
+    - для кожного поля сортування - відсортований список (ключ, рядок):
+      префікс назви, діапазони current_qty/max_qty/price і курсор
+      сторінки - це пошук bisect у ньому.
+
+    upsert() оновлює всі індекси на місці, тож після злиття нових
+    результатів читання не перечитує файл.
+    """
+
+    def __init__(self, categorize: Callable[[str], str] = lambda name: ''):
+        self.categorize = categorize
+        self.version = 0  # збільшується з кожною зміною
+        self._ids: Dict[Tuple[str, str, str], int] = {}  # (page_name, car_name, SKU) → рядок
+        self._next_id = 0
+        self._rows: Dict[int, Dict] = {}
+        self._by_sku: Dict[str, Set[int]] = {}
+        self._by_category: Dict[str, Set[int]] = {}
+        self._by_trigram: Dict[str, Set[int]] = {}
+        self._sorted: Dict[str, List[Tuple[Tuple, int]]] = {field: [] for field in SORT_FIELDS}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _row(self, record: Dict) -> Dict:
+        return {
+            'car_name': record.get('car_name', ''),
+            'SKU': record.get('SKU', ''),
+            'page_name': record.get('page_name', ''),
+            'max_qty': int(record.get('max_qty') or 0),
+            'current_qty': int(record.get('current_qty') or 0),
+            'image_url': record.get('image_url', ''),
+            'price': _price(record.get('price')),
+            'uid': record.get('uid', ''),
+            'category': self.categorize(record.get('car_name', '')),
+        }
+
+    def _unlink(self, row_id: int, row: Dict) -> None:
+        self._by_sku[row['SKU']].discard(row_id)
+        self._by_category[row['category']].discard(row_id)
+        for trigram in _trigrams(row['car_name'].lower()):
+            self._by_trigram[trigram].discard(row_id)
+        for field, entries in self._sorted.items():
+            entry = (_sort_key(field, row), row_id)
+            del entries[bisect_left(entries, entry)]
+
+    def _link(self, row_id: int, row: Dict) -> None:
+        self._rows[row_id] = row
+        self._by_sku.setdefault(row['SKU'], set()).add(row_id)
+        self._by_category.setdefault(row['category'], set()).add(row_id)
+        for trigram in _trigrams(row['car_name'].lower()):
+            self._by_trigram.setdefault(trigram, set()).add(row_id)
+        for field, entries in self._sorted.items():
+            insort(entries, (_sort_key(field, row), row_id))
+
+    def upsert(self, record: Dict) -> None:
+        """Додає або оновлює продукт (словник як Product.to_csv_dict())."""
+        row = self._row(record)
+        key = (row['page_name'], row['car_name'], row['SKU'])
+        with self._lock:
+            row_id = self._ids.get(key)
+            if row_id is None:
+                row_id = self._ids[key] = self._next_id
+                self._next_id += 1
+            else:
+                old = self._rows[row_id]
+                if old == row:
+                    return
+                self._unlink(row_id, old)
+            self._link(row_id, row)
+            self.version += 1
+
+    def remove(self, key: Tuple[str, str, str]) -> None:
+        """Прибирає продукт за ключем (page_name, car_name, SKU), наприклад після перейменування."""
+        with self._lock:
+            row_id = self._ids.pop(key, None)
+            if row_id is None:
+                return
+            self._unlink(row_id, self._rows.pop(row_id))
+            self.version += 1
+
+    def load(self, records: Iterable[Dict]) -> None:
+        """Заповнює індекс заново: сортування один раз, а не вставка по одному."""
+        with self._lock:
+            self._ids.clear()
+            self._rows.clear()
+            self._by_sku.clear()
+            self._by_category.clear()
+            self._by_trigram.clear()
+            for record in records:
+                row = self._row(record)
+                row_id = self._ids.setdefault((row['page_name'], row['car_name'], row['SKU']), len(self._ids))
+                self._rows[row_id] = row
+            for row_id, row in self._rows.items():
+                self._by_sku.setdefault(row['SKU'], set()).add(row_id)
+                self._by_category.setdefault(row['category'], set()).add(row_id)
+                for trigram in _trigrams(row['car_name'].lower()):
+                    self._by_trigram.setdefault(trigram, set()).add(row_id)
+            for field in SORT_FIELDS:
+                self._sorted[field] = sorted((_sort_key(field, row), row_id) for row_id, row in self._rows.items())
+            self._next_id = len(self._ids)
+            self.version += 1
+
+    def by_sku(self, sku: str) -> List[Dict]:
+        with self._lock:
+            return [dict(self._rows[row_id]) for row_id in sorted(self._by_sku.get(sku, ()))]
+
+    def categories(self) -> Dict[str, int]:
+        with self._lock:
+            return {category: len(ids) for category, ids in sorted(self._by_category.items()) if ids}
+
+    def _range(self, field: str, low: Optional[float], high: Optional[float]) -> Set[int]:
+        entries = self._sorted[field]
+        start = 0 if low is None else bisect_left(entries, ((False, low),))
+        if high is None:
+            end = bisect_left(entries, ((True,),))  # до продуктів без значення
+        else:
+            end = bisect_right(entries, ((False, high), float('inf')))
+        return {row_id for _, row_id in entries[start:end]}
+
+    def _candidates(self, q: Optional[str], sku: Optional[str], category: Optional[str],
+                    available: Optional[str], ranges: Dict[str, Tuple[Optional[float], Optional[float]]]) -> Optional[Set[int]]:
+        """Рядки, що проходять фільтри (None - усі)."""
+        sets = []
+        if sku:
+            sets.append(self._by_sku.get(sku, set()))
+        if category:
+            sets.append(self._by_category.get(category, set()))
+        if q and len(q) >= 3:
+            sets.extend(self._by_trigram.get(trigram, set()) for trigram in _trigrams(q))
+        for field, (low, high) in ranges.items():
+            sets.append(self._range(field, low, high))
+        if available == 'in_stock':
+            sets.append(self._range('current_qty', 1, None))
+        elif available == 'sold_out':
+            sets.append(self._range('current_qty', None, 0))
+
+        if not sets:
+            candidates = None
+        else:
+            sets.sort(key=len)
+            candidates = set(sets[0]).intersection(*sets[1:])
+        if q:
+            # Триграми дають кандидатів; підрядок (і короткі запити) перевіряються по назві
+            pool = self._rows if candidates is None else candidates
+            candidates = {row_id for row_id in pool if q in self._rows[row_id]['car_name'].lower()}
+        return candidates
+
+    def query(self, q: Optional[str] = None, prefix: Optional[str] = None, sku: Optional[str] = None,
+              category: Optional[str] = None, available: Optional[str] = None,
+              ranges: Optional[Dict[str, Tuple[Optional[float], Optional[float]]]] = None,
+              sort: str = 'car_name', descending: bool = False, cursor: Optional[str] = None,
+              limit: int = QUERY_PAGE_SIZE) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Сторінка результатів і курсор наступної (None - це остання).
+        q - підрядок назви, prefix - початок назви (без урахування регістру);
+        ranges - {поле: (від, до)} для current_qty / max_qty / price.
+        """
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"sort: одне з {', '.join(SORT_FIELDS)}")
+        for field in (ranges or {}):
+            if field not in NUMERIC_FIELDS:
+                raise ValueError(f"діапазон: одне з {', '.join(NUMERIC_FIELDS)}")
+        limit = max(1, min(limit, QUERY_MAX_PAGE_SIZE))
+
+        with self._lock:
+            candidates = self._candidates(q.lower() if q else None, sku, category, available, ranges or {})
+            if prefix:
+                # Префікс - суцільний діапазон у відсортованому списку назв
+                names = self._sorted['car_name']
+                prefix = prefix.lower()
+                start = bisect_left(names, ((prefix,),))
+                end = bisect_left(names, ((prefix + '\uffff',),))
+                matched = {row_id for _, row_id in names[start:end]}
+                candidates = matched if candidates is None else candidates & matched
+
+            entries = self._sorted[sort]
+            if cursor:
+                after = decode_cursor(cursor)
+                position = bisect_left(entries, after) if descending else bisect_right(entries, after)
+            else:
+                position = len(entries) if descending else 0
+            if descending:
+                walk = (entries[i] for i in range(position - 1, -1, -1))
+            else:
+                walk = (entries[i] for i in range(position, len(entries)))
+
+            page: List[Tuple[Tuple, int]] = []
+            for entry in walk:
+                if candidates is None or entry[1] in candidates:
+                    page.append(entry)
+                    if len(page) > limit:
+                        break
+            next_cursor = encode_cursor(*page[limit - 1]) if len(page) > limit else None
+            return [dict(self._rows[row_id]) for _, row_id in page[:limit]], next_cursor
+
+
+class _Handler(BaseHTTPRequestHandler):
+    index: ProductIndex  # задається в QueryServer
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _send(self, status: int, payload) -> None:
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        if status == 200 and etag in (self.headers.get('If-None-Match') or ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/products':
+                self._send(200, self._products(params))
+            elif url.path.startswith('/products/'):
+                items = self.index.by_sku(unquote(url.path[len('/products/'):]))
+                self._send(200 if items else 404, {'items': items})
+            elif url.path == '/categories':
+                self._send(200, {'categories': self.index.categories()})
+            else:
+                self._send(404, {'error': 'not found'})
+        except (ValueError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+
+    def _products(self, params: Dict[str, str]) -> Dict:
+        ranges = {}
+        for field in NUMERIC_FIELDS:
+            low, high = params.get(f'min_{field}'), params.get(f'max_{field}')
+            if low is not None or high is not None:
+                ranges[field] = (float(low) if low else None, float(high) if high else None)
+        items, cursor = self.index.query(
+            q=params.get('q'), prefix=params.get('prefix'), sku=params.get('sku'),
+            category=params.get('category'), available=params.get('available'), ranges=ranges,
+            sort=params.get('sort', 'car_name'), descending=params.get('order') == 'desc',
+            cursor=params.get('cursor'), limit=int(params.get('limit', QUERY_PAGE_SIZE)))
+        return {'items': items, 'next_cursor': cursor}
+
+
+class QueryServer:
+    """
+    HTTP-сервіс запитів над ProductIndex (лише GET, JSON):
+      /products?q=&prefix=&sku=&category=&available=in_stock|sold_out
+               &min_<поле>=&max_<поле>=&sort=&order=asc|desc&limit=&cursor=
+      /products/<SKU>
+      /categories
+    Кожна відповідь має ETag; If-None-Match з тим самим ETag дає 304.
+    """
+
+    def __init__(self, index: ProductIndex, host: str = QUERY_HOST, port: int = QUERY_PORT):
+        handler = type('Handler', (_Handler,), {'index': index})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, name='query-service', daemon=True)
+        self._thread.start()
+        print(f"🔎 Сервіс запитів: {self.address}/products")
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
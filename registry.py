@@ -0,0 +1,95 @@
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+# Константи
+REGISTRY_FILE = 'collections.json'
+DEFAULT_STOREFRONT = 'us'
+
+
+@dataclass
+class Storefront:
+    """
+    Вітрина Mattel Creations. Незадані адреси означають адреси за
+    замовчуванням з api_parser (API_BASE_URL, INVENTORY_API_URL, CHECKOUT_URL).
+    """
+    name: str
+    search_url: Optional[str] = None
+    inventory_url: Optional[str] = None
+    checkout_url: Optional[str] = None
+
+    @property
+    def token_cache_file(self) -> Optional[str]:
+        """Кожна вітрина має власний токен; None - вітрина за замовчуванням (TOKEN_CACHE_FILE)."""
+        return None if self.name == DEFAULT_STOREFRONT else f".token_cache.{self.name}.json"
+
+
+@dataclass
+class CollectionConfig:
+    name: str  # 'колекція|handle', як у запиті пошуку
+    storefront: str = DEFAULT_STOREFRONT
+    interval: Optional[float] = None  # секунд між оновленнями в режимі --watch
+    enabled: bool = True
+
+
+@dataclass
+class Registry:
+    """Колекції, категорії та вітрини, які відстежує парсер."""
+    collections: List[CollectionConfig]
+    categories: List[List[str]]
+    storefronts: Dict[str, Storefront] = field(default_factory=dict)
+
+    @classmethod
+    def single(cls, collections: List[str], categories: List[List[str]]) -> 'Registry':
+        """Реєстр з однією вітриною за замовчуванням (як до появи collections.json)."""
+        return cls([CollectionConfig(name) for name in collections], categories,
+                   {DEFAULT_STOREFRONT: Storefront(DEFAULT_STOREFRONT)})
+
+    def names(self, storefront: Optional[str] = None) -> List[str]:
+        return [c.name for c in self.collections
+                if c.enabled and (storefront is None or c.storefront == storefront)]
+
+    def by_storefront(self) -> Dict[str, List[str]]:
+        """Увімкнені колекції, згруповані за вітриною (у порядку конфігурації)."""
+        groups: Dict[str, List[str]] = {}
+        for c in self.collections:
+            if c.enabled:
+                groups.setdefault(c.storefront, []).append(c.name)
+        return groups
+
+    def intervals(self) -> Dict[str, float]:
+        return {c.name: c.interval for c in self.collections if c.enabled and c.interval}
+
+
+def load_registry(path: str = REGISTRY_FILE, default: Optional[Registry] = None) -> Registry:
+    """
+    Читає реєстр з JSON. Якщо файлу немає - повертає default.
+    Помилки конфігурації (невідома вітрина, неправильна назва колекції)
+    кидають ValueError: краще не запускатися, ніж мовчки пропустити колекцію.
+    """
+    if not os.path.exists(path):
+        if default is None:
+            raise ValueError(f"Немає файлу реєстру {path}")
+        return default
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    storefronts = {DEFAULT_STOREFRONT: Storefront(DEFAULT_STOREFRONT)}
+    for name, options in data.get('storefronts', {}).items():
+        storefronts[name] = Storefront(name, **options)
+
+    collections = []
+    for entry in data.get('collections', []):
+        config = CollectionConfig(entry) if isinstance(entry, str) else CollectionConfig(**entry)
+        if config.name.count('|') != 1:
+            raise ValueError(f"Колекція '{config.name}': очікується 'колекція|handle'")
+        if config.storefront not in storefronts:
+            raise ValueError(f"Колекція '{config.name}': невідома вітрина '{config.storefront}'")
+        collections.append(config)
+
+    categories = data.get('categories', default.categories if default else None)
+    if not collections or not categories:
+        raise ValueError(f"{path}: потрібні непорожні 'collections' і 'categories'")
+    return Registry(collections, categories, storefronts)
@@ -0,0 +1,265 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import requests
+
+# Налаштування обмеження частоти запитів (на хост)
+RATE_INITIAL = 20.0  # запитів/с на старті
+RATE_MIN = 0.5
+RATE_MAX = 200.0
+RATE_BURST = 10  # скільки запитів можна відправити одразу після паузи
+RATE_INCREASE = 0.5  # адитивне збільшення частоти (запитів/с) за кожен успішний запит
+RATE_DECREASE = 0.5  # мультиплікативне зменшення при 429/5xx
+RATE_DECREASE_COOLDOWN = 1.0  # секунд: помилки запитів, що вже були в польоті, не зменшують частоту вдруге
+RATE_SHARE = 1.0  # частка частоти на процес, коли хост ділять кілька процесів
+
+# Налаштування запобіжника (circuit breaker)
+BREAKER_FAILURE_THRESHOLD = 5  # помилок сервера поспіль, після яких запити призупиняються
+BREAKER_RESET_TIMEOUT = 10.0  # секунд до пробного запиту
+BREAKER_MAX_RESET_TIMEOUT = 120.0
+BREAKER_MAX_TRIPS = 4  # невдалих пробних запитів поспіль, після яких хост вважається недоступним
+
+# Налаштування повторів
+BACKOFF_MAX_DELAY = 30.0  # секунд
+RETRY_AFTER_MAX = 300.0  # довші Retry-After обрізаються
+
+THROTTLE_STATUSES = {429, 503}
+
+
+class CircuitOpenError(requests.RequestException):
+    """Запобіжник хоста розімкнений: сервер не відновився після кількох пробних запитів."""
+
+
+def parse_retry_after(value: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    """Retry-After (секунди або HTTP-дата) -> скільки секунд чекати."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return min(float(value), RETRY_AFTER_MAX)
+    try:
+        moment = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+    now = time.time() if now is None else now
+    return min(max(0.0, moment - now), RETRY_AFTER_MAX)
+
+
+def retry_after_seconds(response) -> Optional[float]:
+    if response is None:
+        return None
+    return parse_retry_after(response.headers.get('Retry-After'))
+
+
+def backoff_delay(attempt: int, base: float, cap: float = BACKOFF_MAX_DELAY) -> float:
+    """Експоненційна затримка з повним джитером: випадково з [base/2, min(cap, base * 2^(attempt-1))]."""
+    ceiling = min(cap, base * 2 ** max(0, attempt - 1))
+    return random.uniform(min(base / 2, ceiling), ceiling)
+
+
+def is_transient(error: Exception) -> bool:
+    """Чи має сенс повторити запит: таймаути, розриви з'єднання, 429 та 5xx."""
+    if isinstance(error, CircuitOpenError):
+        return False
+    response = getattr(error, 'response', None)
+    if response is None:
+        return isinstance(error, requests.RequestException)
+    return response.status_code in THROTTLE_STATUSES or response.status_code >= 500
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket, частота якого підлаштовується під сервер (AIMD):
+    кожен успішний запит додає RATE_INCREASE запитів/с, а 429/5xx зменшують
+    частоту в RATE_DECREASE разів. Retry-After призупиняє всі запити на хост.
+    """
+
+    def __init__(self, rate: float = RATE_INITIAL, min_rate: float = RATE_MIN,
+                 max_rate: float = RATE_MAX, burst: int = RATE_BURST):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Чекає дозволу на один запит. Повертає час очікування в секундах."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                else:
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> bool:
+        """Сигнал перевантаження. Повертає True, якщо частоту зменшено."""
+        with self._lock:
+            now = time.monotonic()
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+                self._tokens = 0.0
+            if now - self._last_decrease < RATE_DECREASE_COOLDOWN:
+                return False
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+            return True
+
+
+class CircuitBreaker:
+    """
+    Запобіжник: після failure_threshold помилок сервера поспіль розмикається,
+    і запити чекають reset_timeout. Потім пропускається один пробний запит
+    (half-open): успіх замикає запобіжник, невдача знову розмикає його з
+    подвоєним таймаутом. Після max_trips невдалих проб acquire() кидає
+    CircuitOpenError (поточний запуск припиняється), але раз на
+    BREAKER_MAX_RESET_TIMEOUT знову пропускає пробний запит: довгоживучий
+    процес (--watch) відновлюється, щойно відновиться сервер.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT, max_trips: int = BREAKER_MAX_TRIPS):
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_trips = max_trips
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0  # розмикань поспіль без успішного запиту
+        self.total_trips = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._condition = threading.Condition()
+
+    @property
+    def gave_up(self) -> bool:
+        return self.trips >= self.max_trips
+
+    def _probe_due(self, now: float) -> bool:
+        """Чи можна пропустити пробний запит після відмови."""
+        if self.state == self.OPEN:
+            return now - self._opened_at >= BREAKER_MAX_RESET_TIMEOUT
+        return self.state == self.HALF_OPEN and not self._probe_in_flight
+
+    def acquire(self) -> None:
+        """Чекає, поки запит можна відправити (або стане пробним)."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self.gave_up and not self._probe_due(now):
+                    raise CircuitOpenError(f"сервер не відповідає після {self.trips} спроб відновлення")
+                if self.state == self.CLOSED:
+                    return
+                if self.state == self.OPEN:
+                    remaining = self._opened_at + self.reset_timeout - now
+                    if remaining <= 0:
+                        self.state = self.HALF_OPEN
+                        self._probe_in_flight = True
+                        return
+                    self._condition.wait(remaining)
+                elif not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    return
+                else:
+                    self._condition.wait()
+
+    def record_success(self) -> None:
+        with self._condition:
+            if self.state != self.CLOSED:
+                print("✅ Сервер відновився, продовжуємо")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trips = 0
+            self.reset_timeout = self.base_reset_timeout
+            self._probe_in_flight = False
+            self._condition.notify_all()
+
+    def record_failure(self) -> bool:
+        """Помилка сервера. Повертає True, якщо запобіжник щойно розімкнувся."""
+        with self._condition:
+            if self.state == self.HALF_OPEN:
+                self.reset_timeout = min(BREAKER_MAX_RESET_TIMEOUT, self.reset_timeout * 2)
+            elif self.state == self.CLOSED:
+                self.failures += 1
+                if self.failures < self.failure_threshold:
+                    return False
+            else:
+                return False  # відповіді на запити, відправлені до розмикання
+            self.state = self.OPEN
+            self.trips += 1
+            self.total_trips += 1
+            self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+            self._condition.notify_all()
+            return True
+
+    def release_probe(self) -> None:
+        """Пробний запит завершився без відповіді про стан сервера (наприклад, скасований)."""
+        with self._condition:
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+                self._condition.notify_all()
+
+
+class HostGuard:
+    """Обмежувач частоти та запобіжник одного хоста."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.limiter = AdaptiveRateLimiter(rate=RATE_INITIAL * RATE_SHARE, min_rate=RATE_MIN * RATE_SHARE,
+                                           max_rate=RATE_MAX * RATE_SHARE)
+        self.breaker = CircuitBreaker()
+        self.throttled = 0
+
+    def before_request(self) -> float:
+        """Чекає на запобіжник і token bucket. Повертає час очікування в секундах."""
+        started = time.monotonic()
+        self.breaker.acquire()
+        try:
+            self.limiter.acquire()
+        except BaseException:
+            self.breaker.release_probe()
+            raise
+        return time.monotonic() - started
+
+    def after_response(self, status: Optional[int], retry_after: Optional[float] = None) -> None:
+        """status=None - запит не дійшов до відповіді (таймаут, розрив з'єднання)."""
+        if status is not None and status < 500 and status != 429:
+            self.limiter.on_success()
+            self.breaker.record_success()
+            return
+
+        self.throttled += 1
+        if self.limiter.on_throttle(retry_after):
+            print(f"🐢 {self.host}: HTTP {status or 'помилка'}, частота знижена до {self.limiter.rate:.1f} запитів/с"
+                  + (f", пауза {retry_after:.0f}с (Retry-After)" if retry_after else ""))
+        if status == 429:
+            self.breaker.release_probe()  # сервер працює, просто просить зачекати
+        elif self.breaker.record_failure():
+            print(f"🔌 {self.host}: {self.breaker.failures} помилок поспіль, "
+                  f"пауза {self.breaker.reset_timeout:.0f}с перед пробним запитом")
+
+    def stats(self) -> Dict[str, object]:
+        return {'rate': round(self.limiter.rate, 1), 'throttled': self.throttled,
+                'breaker': self.breaker.state, 'trips': self.breaker.total_trips}
@@ -0,0 +1,47 @@
+import math
+
+import pytest
+
+from api_parser import BatchSizer
+
+
+def converge(limit: int, maximum: int = 100, initial: int = 25, requests: int = 200) -> BatchSizer:
+    """Проганяє BatchSizer проти сервера, що відхиляє пакети більші за limit."""
+    sizer = BatchSizer(initial=initial, maximum=maximum)
+    for _ in range(requests):
+        if sizer.size > limit:
+            sizer.record_rejection(sizer.size)
+        else:
+            sizer.record_success(sizer.size)
+    return sizer
+
+
+@pytest.mark.parametrize('limit', [1, 2, 7, 24, 25, 37, 50, 61, 99])
+def test_rejections_stay_logarithmic(limit):
+    sizer = converge(limit)
+    assert sizer.size == limit
+    assert sizer.rejections <= math.ceil(math.log2(100)) + 1
+
+
+def test_no_rejections_below_limit():
+    sizer = converge(limit=100)
+    assert sizer.size == 100
+    assert sizer.rejections == 0
+
+
+def test_partial_batches_do_not_move_limits():
+    sizer = converge(limit=50)
+    # Неповні пакети (половини відхиленого, кінець черги) межу не зсувають
+    sizer.record_success(3)
+    assert (sizer.size, sizer.floor, sizer.ceiling) == (50, 50, 51)
+
+
+def test_lowered_server_limit_is_found_again():
+    sizer = converge(limit=60)
+    sizer.record_rejection(60)
+    for _ in range(50):
+        if sizer.size > 30:
+            sizer.record_rejection(sizer.size)
+        else:
+            sizer.record_success(sizer.size)
+    assert sizer.size == 30
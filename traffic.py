@@ -0,0 +1,261 @@
+import argparse
+import gzip
+import json
+import threading
+import time
+import zlib
+from collections import Counter, deque
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Константи
+TRAFFIC_FILE = 'traffic.jsonl.gz'
+TRAFFIC_FLUSH_EVERY = 100  # записів між скиданнями gzip на диск (щоб обірваний запис можна було прочитати)
+RECORDED_HEADERS = ('Content-Type', 'ETag', 'Retry-After')  # інші заголовки відповіді не зберігаються
+REPLAY_BATCH_PARAM = 'productIds'  # пакетний параметр: відповідь можна скласти з елементів інших пакетів
+REPLAY_TIMINGS = ('fast', 'original')
+
+
+def _path(url: str) -> str:
+    return urlsplit(url).path
+
+
+def _request_key(url: str, params: Optional[Dict]) -> str:
+    """
+    Ключ запиту: шлях і відсортовані параметри. Хост не враховується
+    (порт сервера бенчмарку щоразу інший).
+    """
+    return json.dumps([_path(url), sorted((params or {}).items())])
+
+
+class TrafficRecorder:
+    """
+    Записує кожен запит і відповідь (URL, параметри, статус, тіло, час) у
+    стиснутий JSONL. Заголовок Authorization не записується ніколи.
+    """
+
+    def __init__(self, path: str = TRAFFIC_FILE):
+        self.path = path
+        self.count = 0
+        self._started = time.monotonic()
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def _write(self, entry: Dict) -> None:
+        with self._lock:
+            if self._file is None:
+                return
+            entry['t'] = round(time.monotonic() - self._started - entry['elapsed'], 4)
+            self._file.write(json.dumps(entry) + '\n')
+            self.count += 1
+            if self.count % TRAFFIC_FLUSH_EVERY == 0:
+                self._file.flush()
+
+    @staticmethod
+    def _entry(url: str, params: Optional[Dict], headers: Optional[Dict], elapsed: float) -> Dict:
+        return {'url': url, 'params': params or {},
+                'if_none_match': (headers or {}).get('If-None-Match'),
+                'elapsed': round(elapsed, 4)}
+
+    def record(self, url: str, params: Optional[Dict], headers: Optional[Dict], response, elapsed: float) -> None:
+        """Зберігає відповідь. Читає все тіло, тож response.iter_content далі віддає його з пам'яті."""
+        entry = self._entry(url, params, headers, elapsed)
+        entry['status'] = response.status_code
+        entry['headers'] = {name: response.headers[name] for name in RECORDED_HEADERS if name in response.headers}
+        # surrogateescape: тіло відновлюється байт у байт, навіть якщо це не UTF-8
+        entry['body'] = response.content.decode('utf-8', 'surrogateescape')
+        self._write(entry)
+
+    def record_error(self, url: str, params: Optional[Dict], headers: Optional[Dict],
+                     error: Exception, elapsed: float) -> None:
+        """Запит без відповіді (таймаут, розрив з'єднання) - відтворюється тим самим винятком."""
+        entry = self._entry(url, params, headers, elapsed)
+        entry['error'] = type(error).__name__
+        entry['message'] = str(error)
+        self._write(entry)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        print(f"📼 Записано {self.count} запитів у {self.path}")
+
+
+def read_traffic(path: str = TRAFFIC_FILE) -> List[Dict]:
+    """Усі записи файлу. Обірваний кінець (запуск упав) відкидається."""
+    entries = []
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                entries.append(json.loads(line))
+    except (EOFError, zlib.error, gzip.BadGzipFile):
+        pass
+    return entries
+
+
+def _response(entry: Dict, url: str) -> requests.Response:
+    response = requests.Response()
+    response.status_code = entry['status']
+    response.headers = CaseInsensitiveDict(entry.get('headers', {}))
+    response.url = url
+    response.encoding = 'utf-8'
+    response._content = entry['body'].encode('utf-8', 'surrogateescape')
+    response._content_consumed = True  # iter_content віддає _content частинами
+    return response
+
+
+def _raise(entry: Dict) -> None:
+    error = getattr(requests.exceptions, entry['error'], None)
+    if not isinstance(error, type) or not issubclass(error, requests.RequestException):
+        error = requests.ConnectionError
+    raise error(entry.get('message') or 'recorded error')
+
+
+class TrafficReplayer:
+    """
+    Відповідає на запити з запису, без мережі.
+
+    Записи того самого запиту віддаються в порядку запису (401, потім
+    успіх після оновлення токена - так само, як було), далі повторюється
+    остання успішна відповідь. Відповідь 304 віддається лише умовному
+    запиту. Пакетні запити (REPLAY_BATCH_PARAM), яких немає в записі
+    дослівно (або записані відповіді вичерпано), складаються з елементів
+    записаних пакетів: розбиття на пакети між запусками відрізняється.
+
+    timing='original' - відповідь віддається в той самий момент від початку
+    відтворення, що й у записі (зсув запиту t плюс його тривалість), тож
+    зберігаються і паузи між запитами; складені та повторені відповіді
+    чекають лише тривалість запиту. 'fast' - відповідає одразу.
+    """
+
+    def __init__(self, path: str = TRAFFIC_FILE, timing: str = 'fast'):
+        if timing not in REPLAY_TIMINGS:
+            raise ValueError(f"Невідомий режим часу відтворення: {timing}")
+        self.path = path
+        self.timing = timing
+        self.served = 0
+        self.composed = 0
+        self.missing = 0
+        self._entries: Dict[str, deque] = {}
+        self._last: Dict[str, Dict] = {}
+        self._items: Dict[str, Dict[str, Dict]] = {}  # шлях → id елемента → елемент пакетної відповіді
+        self._elapsed: Dict[str, List[float]] = {}  # шлях → тривалість успішних пакетів (для складених відповідей)
+        self._requested: Dict[str, set] = {}  # шлях → id з успішних пакетів (відсутні у відповіді - порожні)
+        self._started: Optional[float] = None  # момент першого запиту відтворення
+        self._lock = threading.Lock()
+
+        entries = read_traffic(path)
+        self._origin = min((entry['t'] for entry in entries), default=0.0)  # t першого записаного запиту
+        for entry in entries:
+            self._entries.setdefault(_request_key(entry['url'], entry['params']), deque()).append(entry)
+            if REPLAY_BATCH_PARAM in entry['params'] and entry.get('status') == 200:
+                self._index_batch(entry)
+        print(f"📼 Відтворення {len(entries)} запитів з {path} ({timing})")
+
+    def _index_batch(self, entry: Dict) -> None:
+        try:
+            items = json.loads(entry['body'])
+        except ValueError:
+            return
+        if not isinstance(items, list):
+            return
+        ids = entry['params'][REPLAY_BATCH_PARAM].split(',')
+        self._requested.setdefault(_path(entry['url']), set()).update(ids)
+        self._elapsed.setdefault(_path(entry['url']), []).append(entry['elapsed'])
+        by_id = self._items.setdefault(_path(entry['url']), {})
+        for item in items:
+            if isinstance(item, dict) and item.get('id'):
+                by_id[item['id']] = item
+        # Відповідь на один продукт може не містити id
+        if len(ids) == 1 and len(items) == 1 and isinstance(items[0], dict):
+            by_id.setdefault(ids[0], items[0])
+
+    def _take(self, key: str, conditional: bool) -> Optional[Dict]:
+        queued = self._entries.get(key, deque())
+        eligible = [entry for entry in queued if conditional or entry.get('status') != 304]
+        # Спершу запис з тим самим If-None-Match, що й у цьому запиті
+        matching = [entry for entry in eligible if bool(entry.get('if_none_match')) == conditional]
+        if matching or eligible:
+            entry = (matching or eligible)[0]
+            queued.remove(entry)
+            self._last[key] = entry
+            return entry
+        # Помилки не повторюються: інакше повтори запиту ніколи не закінчаться
+        last = self._last.get(key)
+        if last is not None and last.get('status', 500) < 400 and (conditional or last['status'] != 304):
+            return {name: value for name, value in last.items() if name != 't'}  # повтор - поза розкладом запису
+        return None
+
+    def _compose(self, url: str, params: Dict) -> Optional[Dict]:
+        by_id = self._items.get(_path(url), {})
+        ids = params[REPLAY_BATCH_PARAM].split(',')
+        if not self._requested.get(_path(url), set()).issuperset(ids):
+            return None
+        items = [by_id[item_id] for item_id in ids if item_id in by_id]
+        self.composed += 1
+        elapsed = self._elapsed[_path(url)]
+        return {'status': 200, 'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps(items), 'elapsed': sum(elapsed) / len(elapsed)}
+
+    def _delay(self, entry: Dict) -> float:
+        """Скільки чекати до моменту, коли відповідь прийшла в записі."""
+        if 't' not in entry:
+            return entry['elapsed']
+        due = self._started + entry['t'] - self._origin + entry['elapsed']
+        return max(0.0, due - time.monotonic())
+
+    def get(self, url: str, params: Optional[Dict] = None, headers: Optional[Dict] = None) -> requests.Response:
+        params = params or {}
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+            entry = self._take(_request_key(url, params), bool((headers or {}).get('If-None-Match')))
+            if entry is None and REPLAY_BATCH_PARAM in params:
+                entry = self._compose(url, params)
+            if entry is None:
+                self.missing += 1
+            else:
+                self.served += 1
+        if entry is None:
+            raise requests.ConnectionError(f"Запиту немає в записі {self.path}: {url} {params}")
+        if self.timing == 'original':
+            time.sleep(self._delay(entry))
+        if 'error' in entry:
+            _raise(entry)
+        return _response(entry, url)
+
+    def print_stats(self) -> None:
+        print(f"📼 Відтворено {self.served} відповідей (складено з пакетів: {self.composed}, "
+              f"немає в записі: {self.missing})")
+
+
+def summarize(entries: List[Dict]) -> Dict[str, Counter]:
+    """Кількість записів за шляхом і статусом (або назвою винятку)."""
+    summary: Dict[str, Counter] = {}
+    for entry in entries:
+        path = urlsplit(entry['url']).path
+        summary.setdefault(path, Counter())[str(entry.get('status', entry.get('error')))] += 1
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Зведення записаного трафіку API")
+    parser.add_argument('path', nargs='?', default=TRAFFIC_FILE)
+    args = parser.parse_args()
+
+    entries = read_traffic(args.path)
+    duration = max((entry['t'] + entry['elapsed'] for entry in entries), default=0.0)
+    print(f"📼 {args.path}: {len(entries)} запитів за {duration:.1f}с")
+    for path, statuses in summarize(entries).items():
+        counts = ', '.join(f"{status}: {count}" for status, count in sorted(statuses.items()))
+        print(f"   {path}  {counts}")
+
+
+if __name__ == "__main__":
+    main()